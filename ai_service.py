@@ -1,89 +1,229 @@
+import asyncio
 import openai
 import json
 import re
-from typing import Dict, List, Tuple, Optional
+import time
+from typing import AsyncIterator, Dict, List, Set, Tuple, Optional
 from config import settings
 from database import KnowledgeBase
 from sqlalchemy.orm import Session
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import faiss
+from analysis_cache import analysis_cache
+from keyword_matcher import KeywordHits, keyword_matcher
+from llm_client import llm_client
+from llm_metrics import llm_metrics
+from prompt_builder import MESSAGE_OVERHEAD_TOKENS, TokenCounter, fit_to_budget, strip_quoted_text
+from local_sentiment import LocalSentimentClassifier
+from bm25 import reciprocal_rank_fusion
+from singleflight import SingleFlight
+from model_registry import (
+    get_bm25_index, get_embedding_model, get_knowledge_base_index,
+    is_embedding_model_loaded, load_embedding_model_in_background
+)
+from vector_index import item_content_hash, embedding_to_blob, blob_to_embedding
+
+# Bump when a prompt changes so cached results from the old prompt are not reused
+SENTIMENT_PROMPT_VERSION = "1"
+RESPONSE_PROMPT_VERSION = "1"
+
+# Identical retrieval queries running at the same time share one search
+_retrieval_flight = SingleFlight()
 
 class AIService:
     def __init__(self):
         openai.api_key = settings.OPENAI_API_KEY
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.knowledge_base_embeddings = None
-        self.knowledge_base_texts = []
-        self.knowledge_base_answers = []
+        # Shared across every AIService in the process, see model_registry
+        self.knowledge_base_index = get_knowledge_base_index()
+        self.bm25_index = get_bm25_index()
+        # Outage and urgency phrases signal an unhappy customer even without emotional words
+        self.local_sentiment_classifier = LocalSentimentClassifier(
+            negative_cues=settings.URGENCY_KEYWORDS + settings.TIME_SENSITIVE_KEYWORDS
+        )
+        self.token_counter = TokenCounter(settings.OPENAI_MODEL)
+    
+    @property
+    def model(self):
+        """Embedding model, loaded on first use"""
+        return get_embedding_model()
+    
+    @property
+    def knowledge_base_answers(self) -> Dict[int, str]:
+        return self.knowledge_base_index.answers
+        
+    def analyze_sentiment(self, text: str, fallback: str = 'neutral') -> str:
+        """Analyze sentiment of email text using OpenAI, returning fallback if it gives no answer"""
+        cache_key = self._sentiment_cache_key(text)
+        cached = analysis_cache.get('sentiment', cache_key)
+        if cached is not None:
+            llm_metrics.record_cache_hit()
+            return cached
         
-    def analyze_sentiment(self, text: str) -> str:
-        """Analyze sentiment of email text using OpenAI"""
         try:
-            response = openai.ChatCompletion.create(
-                model=settings.OPENAI_MODEL,
+            result = llm_client.complete(
                 messages=[
                     {"role": "system", "content": "You are a sentiment analysis expert. Analyze the sentiment of the following text and respond with exactly one word: 'positive', 'negative', or 'neutral'."},
                     {"role": "user", "content": f"Analyze the sentiment of this text: {text[:1000]}"}
                 ],
                 max_tokens=10,
-                temperature=0.1
+                temperature=0.1,
+                operation='sentiment'
             )
-            sentiment = response.choices[0].message.content.strip().lower()
+            sentiment = result.text.strip().lower()
             if sentiment in ['positive', 'negative', 'neutral']:
+                analysis_cache.set('sentiment', cache_key, sentiment)
                 return sentiment
-            return 'neutral'
+            return fallback
         except Exception as e:
             print(f"Error in sentiment analysis: {e}")
-            return 'neutral'
+            llm_metrics.record_fallback('sentiment')
+            return fallback
     
-    def detect_priority(self, text: str, subject: str) -> str:
-        """Detect if email is urgent based on keywords and context"""
-        text_lower = (text + " " + subject).lower()
+    def _sentiment_cache_key(self, text: str) -> str:
+        return analysis_cache.make_key('sentiment', settings.OPENAI_MODEL, SENTIMENT_PROMPT_VERSION, text[:1000])
+    
+    def local_sentiment(self, text: str) -> Tuple[str, float]:
+        """Classify sentiment offline, returning the label and its confidence"""
+        return self.local_sentiment_classifier.classify(text)
+    
+    def analyze_sentiment_batch(self, texts: List[str]) -> List[str]:
+        """Analyze sentiment of many emails, escalating only low-confidence ones to OpenAI"""
+        local_results = [self.local_sentiment(text) for text in texts]
+        sentiments = [sentiment for sentiment, _ in local_results]
         
-        # Check for urgency keywords
-        urgency_score = sum(1 for keyword in settings.URGENCY_KEYWORDS if keyword in text_lower)
+        escalated = []
+        for i, (_, confidence) in enumerate(local_results):
+            if confidence >= settings.LOCAL_SENTIMENT_CONFIDENCE_THRESHOLD:
+                continue
+            cached = analysis_cache.get('sentiment', self._sentiment_cache_key(texts[i]))
+            if cached is not None:
+                sentiments[i] = cached
+            else:
+                escalated.append(i)
         
-        # Check for time-sensitive indicators
-        time_patterns = [
-            r'\b(immediately|asap|urgent|critical)\b',
-            r'\b(cannot access|broken|down|not working)\b',
-            r'\b(emergency|help needed|stuck)\b'
-        ]
+        if escalated:
+            llm_sentiments = self._analyze_sentiment_llm_batch(
+                [texts[i] for i in escalated],
+                [sentiments[i] for i in escalated]
+            )
+            for i, sentiment in zip(escalated, llm_sentiments):
+                sentiments[i] = sentiment
+        
+        return sentiments
+    
+    def _analyze_sentiment_llm_batch(self, texts: List[str], fallbacks: List[str]) -> List[str]:
+        """Analyze sentiment of many emails in a single OpenAI request"""
+        if len(texts) == 1:
+            return [self.analyze_sentiment(texts[0], fallbacks[0])]
+        
+        numbered_emails = "\n\n".join(
+            f"Email {i}:\n{text[:1000]}" for i, text in enumerate(texts, 1)
+        )
         
-        time_score = sum(len(re.findall(pattern, text_lower)) for pattern in time_patterns)
+        try:
+            result = llm_client.complete(
+                messages=[
+                    {"role": "system", "content": "You are a sentiment analysis expert. For each numbered email, classify the sentiment as 'positive', 'negative', or 'neutral'. Respond with only a JSON array of objects like {\"id\": 1, \"sentiment\": \"negative\"}, one per email."},
+                    {"role": "user", "content": f"Analyze the sentiment of these {len(texts)} emails:\n\n{numbered_emails}"}
+                ],
+                max_tokens=15 * len(texts) + 20,
+                temperature=0.1,
+                operation='sentiment_batch'
+            )
+            content = result.text.strip()
+        except Exception as e:
+            print(f"Error in batch sentiment analysis: {e}")
+            llm_metrics.record_fallback('sentiment_batch')
+            return list(fallbacks)
         
-        # Check for emotional intensity
-        emotional_words = ['frustrated', 'angry', 'desperate', 'helpless', 'urgent']
-        emotional_score = sum(1 for word in emotional_words if word in text_lower)
+        sentiments = [None] * len(texts)
+        try:
+            # Tolerate prose or code fences around the JSON array
+            match = re.search(r'\[.*\]', content, re.DOTALL)
+            for entry in json.loads(match.group(0) if match else content):
+                index = int(entry['id']) - 1
+                sentiment = str(entry['sentiment']).strip().lower()
+                if 0 <= index < len(texts) and sentiment in ['positive', 'negative', 'neutral']:
+                    sentiments[index] = sentiment
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Error parsing batch sentiment response: {e}")
         
-        total_score = urgency_score + time_score + emotional_score
+        for text, sentiment in zip(texts, sentiments):
+            if sentiment is not None:
+                analysis_cache.set('sentiment', self._sentiment_cache_key(text), sentiment)
         
-        if total_score >= 2:
+        # Fall back to single-email analysis for anything the batch did not answer
+        return [
+            sentiment if sentiment is not None else self.analyze_sentiment(text, fallback)
+            for text, sentiment, fallback in zip(texts, sentiments, fallbacks)
+        ]
+    
+    def scan_keywords(self, subject: str, body: str) -> KeywordHits:
+        """Match every configured keyword list against an email in a single pass"""
+        return keyword_matcher.scan(subject + " " + body)
+    
+    def detect_priority(self, text: str, subject: str, hits: Optional[KeywordHits] = None) -> str:
+        """Detect if email is urgent based on keywords and context"""
+        if self.urgency_score(text, subject, hits) >= 2:
             return 'urgent'
         return 'not_urgent'
     
-    def categorize_email(self, subject: str, body: str) -> str:
+    def urgency_score(self, text: str, subject: str, hits: Optional[KeywordHits] = None) -> int:
+        """Raw urgency score behind detect_priority, used to rank within a priority tier"""
+        hits = hits or self.scan_keywords(subject, text)
+        
+        # Urgency keywords, time-sensitive phrases and emotional intensity
+        urgency_score = hits.distinct('urgency')
+        time_score = hits.occurrences('time_sensitive')
+        emotional_score = hits.distinct('emotional')
+        
+        return urgency_score + time_score + emotional_score
+    
+    def categorize_email(self, subject: str, body: str, hits: Optional[KeywordHits] = None) -> str:
         """Categorize email based on content"""
-        text_lower = (subject + " " + body).lower()
-        
-        categories = {
-            'support': ['support', 'help', 'assistance', 'issue', 'problem'],
-            'query': ['question', 'inquiry', 'ask', 'wondering'],
-            'request': ['request', 'need', 'want', 'require'],
-            'complaint': ['complaint', 'dissatisfied', 'unhappy', 'disappointed'],
-            'feedback': ['feedback', 'suggestion', 'improvement', 'review']
-        }
+        hits = hits or self.scan_keywords(subject, body)
         
-        scores = {}
-        for category, keywords in categories.items():
-            scores[category] = sum(1 for keyword in keywords if keyword in text_lower)
+        scores = {
+            category: hits.distinct(f'category:{category}') for category in settings.CATEGORY_KEYWORDS
+        }
         
         # Return category with highest score
         if max(scores.values()) > 0:
             return max(scores, key=scores.get)
         return 'general'
     
+    def classify_batch(self, emails: List[Dict]) -> Dict[str, np.ndarray]:
+        """Classify many emails at once from a keyword hit matrix.
+        
+        Each email is a dict with 'subject' and 'body' (and optionally the
+        'keyword_hits' from an earlier scan). Returns arrays aligned with the
+        input: priority, category, is_support and urgency_score.
+        """
+        categories = list(settings.CATEGORY_KEYWORDS)
+        distinct_rules = ['support', 'urgency', 'emotional'] + [f'category:{c}' for c in categories]
+        
+        distinct_hits = np.zeros((len(emails), len(distinct_rules)), dtype=np.int32)
+        time_hits = np.zeros(len(emails), dtype=np.int32)
+        for row, email_data in enumerate(emails):
+            hits = email_data.get('keyword_hits') or self.scan_keywords(email_data['subject'], email_data['body'])
+            distinct_hits[row] = [hits.distinct(rule) for rule in distinct_rules]
+            time_hits[row] = hits.occurrences('time_sensitive')
+        
+        support_hits = distinct_hits[:, 0]
+        urgency_scores = distinct_hits[:, 1] + time_hits + distinct_hits[:, 2]
+        category_hits = distinct_hits[:, 3:]
+        
+        # argmax keeps the first category on ties, matching categorize_email
+        category_labels = np.array(categories + ['general'], dtype=object)
+        best_category = np.argmax(category_hits, axis=1) if categories else np.zeros(len(emails), dtype=int)
+        has_category = category_hits.max(axis=1, initial=0) > 0
+        
+        return {
+            'priority': np.where(urgency_scores >= 2, 'urgent', 'not_urgent').astype(object),
+            'category': category_labels[np.where(has_category, best_category, len(categories))],
+            'is_support': support_hits > 0,
+            'urgency_score': urgency_scores
+        }
+    
     def extract_information(self, text: str) -> Dict:
         """Extract key information from email text"""
         extracted_info = {
@@ -132,47 +272,289 @@ class AIService:
         return extracted_info
     
     def build_knowledge_base_index(self, db: Session):
-        """Build FAISS index for knowledge base RAG"""
+        """Load the FAISS index for knowledge base RAG, rebuilding it only when the KB changed"""
         knowledge_items = db.query(KnowledgeBase).all()
         
+        # Keyword index is cheap to rebuild from the rows every time
+        self.bm25_index.build({item.id: self._knowledge_base_text(item) for item in knowledge_items})
+        
         if not knowledge_items:
+            self.knowledge_base_index.clear()
             return
         
-        texts = [f"{item.question} {item.answer}" for item in knowledge_items]
-        embeddings = self.model.encode(texts)
+        self.knowledge_base_index.answers = {item.id: item.answer for item in knowledge_items}
+        self.knowledge_base_index.set_categories({item.id: item.category for item in knowledge_items})
+        if settings.KB_RETRIEVAL_MODE == 'bm25':
+            return
         
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        self.knowledge_base_index = faiss.IndexFlatL2(dimension)
-        self.knowledge_base_index.add(embeddings.astype('float32'))
+        item_hashes = {
+            item.id: item_content_hash(item.id, item.question, item.answer) for item in knowledge_items
+        }
         
-        self.knowledge_base_texts = texts
-        self.knowledge_base_answers = [item.answer for item in knowledge_items]
+        # Reuse the on-disk snapshot when nothing changed since it was written
+        if not self.knowledge_base_index.load(item_hashes):
+            embeddings = self._ensure_item_embeddings(knowledge_items, item_hashes, db)
+            self.knowledge_base_index.build([item.id for item in knowledge_items], embeddings, item_hashes)
+            self.knowledge_base_index.save()
     
-    def retrieve_relevant_context(self, query: str, top_k: int = 3) -> List[str]:
-        """Retrieve relevant context from knowledge base using RAG"""
-        if not hasattr(self, 'knowledge_base_index') or self.knowledge_base_index is None:
-            return []
+    @staticmethod
+    def _knowledge_base_text(item: KnowledgeBase) -> str:
+        """Text of a knowledge base item that retrieval matches against"""
+        return f"{item.question} {item.answer}"
+    
+    def _ensure_item_embeddings(self, knowledge_items: List[KnowledgeBase],
+                                item_hashes: Dict[int, str], db: Session) -> np.ndarray:
+        """Return embeddings for the items, encoding only rows whose stored vector is stale"""
+        model_name = self.knowledge_base_index.model_name
+        stale_items = [
+            item for item in knowledge_items
+            if item.embedding is None
+            or item.embedding_model != model_name
+            or item.content_hash != item_hashes[item.id]
+        ]
+        
+        if stale_items:
+            texts = [self._knowledge_base_text(item) for item in stale_items]
+            for item, embedding in zip(stale_items, self._embed(texts, 'knowledge_base')):
+                item.embedding = embedding_to_blob(embedding)
+                item.embedding_model = model_name
+                item.content_hash = item_hashes[item.id]
+            db.commit()
+        
+        return np.vstack([blob_to_embedding(item.embedding) for item in knowledge_items])
+    
+    def _embed(self, texts: List[str], operation: str) -> np.ndarray:
+        """Encode texts with the embedding model, recording the call in llm_metrics"""
+        model_name = self.knowledge_base_index.model_name
+        start = time.perf_counter()
+        try:
+            embeddings = self.model.encode(texts)
+        except Exception:
+            llm_metrics.record_embedding(operation, model_name, time.perf_counter() - start, 'error', len(texts))
+            raise
+        llm_metrics.record_embedding(operation, model_name, time.perf_counter() - start, 'ok', len(texts))
+        return embeddings
+    
+    def upsert_knowledge_base_item(self, item: KnowledgeBase, db: Session):
+        """Embed a single new or edited knowledge base item and update the live indexes"""
+        self.bm25_index.upsert(item.id, self._knowledge_base_text(item))
+        self.knowledge_base_answers[item.id] = item.answer
+        self.knowledge_base_index.set_category(item.id, item.category)
+        if settings.KB_RETRIEVAL_MODE == 'bm25':
+            return
+        
+        item_hash = item_content_hash(item.id, item.question, item.answer)
+        if self.knowledge_base_index.item_hashes.get(item.id) != item_hash:
+            embedding = self._ensure_item_embeddings([item], {item.id: item_hash}, db)[0]
+            self.knowledge_base_index.upsert(item.id, embedding, item_hash)
+            if self.knowledge_base_index.needs_retrain:
+                # Grown well past what the index was trained on: retrain it on the whole knowledge base
+                self.build_knowledge_base_index(db)
+            else:
+                self.knowledge_base_index.save()
+    
+    def remove_knowledge_base_item(self, item_id: int):
+        """Drop a deleted knowledge base item from the live indexes"""
+        self.knowledge_base_answers.pop(item_id, None)
+        self.knowledge_base_index.set_category(item_id, None)
+        self.bm25_index.remove(item_id)
+        if self.knowledge_base_index.remove(item_id):
+            self.knowledge_base_index.save()
+    
+    def retrieve_relevant_context(self, query: str, top_k: int = 3, category: Optional[str] = None) -> List[str]:
+        """Retrieve relevant context from knowledge base using RAG.
+        
+        In hybrid mode BM25 and vector rankings are merged with reciprocal rank
+        fusion; until the embedding model is loaded, BM25 answers alone. With a
+        category, items of that category are preferred and the rest of the
+        knowledge base only fills the remaining slots.
+        """
+        contexts = _retrieval_flight.do(
+            (query, top_k, category),
+            lambda: self._retrieve_relevant_context(query, top_k, category)
+        )
+        # Callers may edit their copy, e.g. when fitting it to the token budget
+        return list(contexts)
+    
+    def _retrieve_relevant_context(self, query: str, top_k: int, category: Optional[str]) -> List[str]:
+        mode = settings.KB_RETRIEVAL_MODE
+        candidates = max(top_k, settings.KB_RETRIEVAL_CANDIDATES)
         
-        query_embedding = self.model.encode([query])
-        D, I = self.knowledge_base_index.search(query_embedding.astype('float32'), top_k)
+        query_embedding = None
+        if mode != 'bm25' and self.knowledge_base_index.size > 0:
+            if mode == 'hybrid' and not is_embedding_model_loaded():
+                # Don't stall this request on the model load
+                load_embedding_model_in_background()
+            else:
+                query_embedding = self._embed([query], 'query')
+        
+        item_ids = []
+        # 'general' is what categorize_email falls back to, so it says nothing about the topic
+        if category and category != 'general':
+            allowed_ids = self.knowledge_base_index.category_ids(category)
+            if allowed_ids:
+                item_ids = self._rank_knowledge_base_items(query, query_embedding, candidates, allowed_ids)[:top_k]
+        if len(item_ids) < top_k:
+            global_ids = self._rank_knowledge_base_items(query, query_embedding, candidates)
+            item_ids += [item_id for item_id in global_ids if item_id not in item_ids][:top_k - len(item_ids)]
         
         relevant_contexts = []
-        for idx in I[0]:
-            if idx < len(self.knowledge_base_answers):
-                relevant_contexts.append(self.knowledge_base_answers[idx])
+        for item_id in item_ids:
+            if item_id in self.knowledge_base_answers:
+                relevant_contexts.append(self.knowledge_base_answers[item_id])
         
         return relevant_contexts
     
+    def _rank_knowledge_base_items(self, query: str, query_embedding: Optional[np.ndarray], candidates: int,
+                                   allowed_ids: Optional[Set[int]] = None) -> List[int]:
+        """Knowledge base ids ranked by BM25 and/or vector similarity"""
+        rankings = []
+        if settings.KB_RETRIEVAL_MODE != 'dense':
+            rankings.append([item_id for item_id, _ in self.bm25_index.search(query, candidates, allowed_ids)])
+        if query_embedding is not None:
+            rankings.append(self.knowledge_base_index.search(query_embedding, candidates, allowed_ids))
+        
+        if not rankings:
+            return []
+        if len(rankings) == 1:
+            return rankings[0]
+        return reciprocal_rank_fusion(rankings, settings.KB_RRF_K)
+    
     def generate_response(self, email_text: str, email_subject: str, sender_email: str, 
                          sentiment: str, priority: str, category: str, 
                          custom_prompt: str = None) -> Tuple[str, float, str]:
         """Generate AI-powered response using RAG and context-aware prompting"""
         
+        # Identical emails from the same sender reuse the earlier draft
+        cache_key = self._response_cache_key(email_text, email_subject, sender_email,
+                                             sentiment, priority, category, custom_prompt)
+        cached = analysis_cache.get('response', cache_key)
+        if cached is not None:
+            llm_metrics.record_cache_hit()
+            generated_response, confidence, reasoning = cached
+            return generated_response, confidence, f"{reasoning} (cached)"
+        
+        messages, relevant_context, prompt_tokens = self._build_response_messages(
+            email_text, email_subject, sender_email, sentiment, priority, category, custom_prompt
+        )
+        
+        try:
+            result = llm_client.complete(messages=messages, max_tokens=500, temperature=0.7, operation='response')
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            llm_metrics.record_fallback('response')
+            return self.fallback_response(priority, category)
+        
+        return self._finish_response(result.text, cache_key, relevant_context, prompt_tokens,
+                                     sentiment, priority, category)
+    
+    async def agenerate_response(self, email_text: str, email_subject: str, sender_email: str,
+                                 sentiment: str, priority: str, category: str,
+                                 custom_prompt: str = None) -> Tuple[str, float, str]:
+        """Async variant of generate_response that never blocks the event loop"""
+        cache_key = self._response_cache_key(email_text, email_subject, sender_email,
+                                             sentiment, priority, category, custom_prompt)
+        cached = await asyncio.to_thread(analysis_cache.get, 'response', cache_key)
+        if cached is not None:
+            llm_metrics.record_cache_hit()
+            generated_response, confidence, reasoning = cached
+            return generated_response, confidence, f"{reasoning} (cached)"
+        
+        # Retrieval runs the embedding model, so keep it off the event loop
+        messages, relevant_context, prompt_tokens = await asyncio.to_thread(
+            self._build_response_messages,
+            email_text, email_subject, sender_email, sentiment, priority, category, custom_prompt
+        )
+        
+        try:
+            result = await llm_client.acomplete(messages=messages, max_tokens=500, temperature=0.7,
+                                                operation='response')
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            llm_metrics.record_fallback('response')
+            return self.fallback_response(priority, category)
+        
+        return await asyncio.to_thread(
+            self._finish_response, result.text, cache_key, relevant_context, prompt_tokens,
+            sentiment, priority, category
+        )
+    
+    async def astream_response(self, email_text: str, email_subject: str, sender_email: str,
+                               sentiment: str, priority: str, category: str,
+                               custom_prompt: str = None) -> AsyncIterator[str]:
+        """Stream a generated response as text deltas; raises LLMError if generation fails"""
+        cache_key = self._response_cache_key(email_text, email_subject, sender_email,
+                                             sentiment, priority, category, custom_prompt)
+        cached = await asyncio.to_thread(analysis_cache.get, 'response', cache_key)
+        if cached is not None:
+            llm_metrics.record_cache_hit()
+            yield cached[0]
+            return
+        
+        messages, relevant_context, prompt_tokens = await asyncio.to_thread(
+            self._build_response_messages,
+            email_text, email_subject, sender_email, sentiment, priority, category, custom_prompt
+        )
+        
+        chunks = []
+        async for delta in llm_client.astream(messages=messages, max_tokens=500, temperature=0.7,
+                                              operation='response_stream'):
+            chunks.append(delta)
+            yield delta
+        
+        await asyncio.to_thread(
+            self._finish_response, "".join(chunks), cache_key, relevant_context, prompt_tokens,
+            sentiment, priority, category
+        )
+    
+    def _response_cache_key(self, email_text: str, email_subject: str, sender_email: str,
+                            sentiment: str, priority: str, category: str, custom_prompt: str) -> str:
+        return analysis_cache.make_key(
+            'response', settings.OPENAI_MODEL, RESPONSE_PROMPT_VERSION, email_text,
+            subject=email_subject, sender=sender_email, sentiment=sentiment,
+            priority=priority, category=category, custom_prompt=custom_prompt or ''
+        )
+    
+    def _build_response_messages(self, email_text: str, email_subject: str, sender_email: str,
+                                 sentiment: str, priority: str, category: str,
+                                 custom_prompt: str) -> Tuple[List[Dict], List[str], int]:
+        """Build the chat messages for a response within the prompt token budget.
+        
+        Returns the messages, the knowledge base context that made it into the
+        prompt and the prompt size in tokens.
+        """
+        
+        # Quoted reply history adds tokens without adding information
+        email_text = strip_quoted_text(email_text)
+        
         # Retrieve relevant context from knowledge base
-        relevant_context = self.retrieve_relevant_context(email_text)
+        relevant_context = self.retrieve_relevant_context(email_text, category=category)
+        
+        # Fit the body and the ranked context into what the fixed prompt leaves over
+        fixed_tokens = (
+            self.token_counter.count(self._response_system_prompt("", sentiment, priority, category))
+            + self.token_counter.count(self._response_user_prompt(sender_email, email_subject, "", custom_prompt))
+            + 2 * MESSAGE_OVERHEAD_TOKENS
+        )
+        email_text, relevant_context = fit_to_budget(
+            self.token_counter, settings.PROMPT_TOKEN_BUDGET, fixed_tokens, email_text, relevant_context
+        )
         context_text = "\n".join(relevant_context) if relevant_context else "No specific knowledge base context available."
         
+        system_prompt = self._response_system_prompt(context_text, sentiment, priority, category)
+        user_prompt = self._response_user_prompt(sender_email, email_subject, email_text, custom_prompt)
+        prompt_tokens = (
+            self.token_counter.count(system_prompt) + self.token_counter.count(user_prompt)
+            + 2 * MESSAGE_OVERHEAD_TOKENS
+        )
+        
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        return messages, relevant_context, prompt_tokens
+    
+    def _response_system_prompt(self, context_text: str, sentiment: str, priority: str, category: str) -> str:
         # Build system prompt with context
         system_prompt = f"""You are a professional customer support AI assistant. Your role is to:
 1. Generate empathetic, helpful, and professional responses
@@ -195,7 +577,10 @@ Guidelines:
 - Be specific and actionable in your response
 - Keep the tone professional yet warm
 - If you don't have enough information, ask clarifying questions"""
-
+        return system_prompt
+    
+    def _response_user_prompt(self, sender_email: str, email_subject: str, email_text: str,
+                              custom_prompt: str) -> str:
         # Build user prompt
         user_prompt = f"""Generate a response to this email:
 
@@ -206,31 +591,24 @@ Content: {email_text}
 {f"Additional Instructions: {custom_prompt}" if custom_prompt else ""}
 
 Please provide a professional, empathetic response that addresses their needs."""
-
-        try:
-            response = openai.ChatCompletion.create(
-                model=settings.OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
-            
-            generated_response = response.choices[0].message.content.strip()
-            
-            # Calculate confidence based on response length and relevance
-            confidence = min(0.9, len(generated_response) / 100)
-            
-            reasoning = f"Generated response for {category} email with {sentiment} sentiment and {priority} priority. Used {len(relevant_context)} relevant knowledge base items."
-            
-            return generated_response, confidence, reasoning
-            
-        except Exception as e:
-            print(f"Error generating response: {e}")
-            fallback_response = f"Thank you for your {category} request. I understand this is {priority} priority. I'm currently processing your inquiry and will get back to you shortly with a detailed response."
-            return fallback_response, 0.5, "Fallback response due to AI service error"
+        return user_prompt
+    
+    def _finish_response(self, generated_response: str, cache_key: str, relevant_context: List[str],
+                         prompt_tokens: int, sentiment: str, priority: str, category: str) -> Tuple[str, float, str]:
+        generated_response = generated_response.strip()
+        
+        # Calculate confidence based on response length and relevance
+        confidence = min(0.9, len(generated_response) / 100)
+        
+        reasoning = f"Generated response for {category} email with {sentiment} sentiment and {priority} priority. Used {len(relevant_context)} relevant knowledge base items. Prompt used {prompt_tokens} of {settings.PROMPT_TOKEN_BUDGET} budgeted tokens."
+        
+        analysis_cache.set('response', cache_key, [generated_response, confidence, reasoning])
+        return generated_response, confidence, reasoning
+    
+    def fallback_response(self, priority: str, category: str) -> Tuple[str, float, str]:
+        """Canned response used when the LLM is unavailable"""
+        fallback_response = f"Thank you for your {category} request. I understand this is {priority} priority. I'm currently processing your inquiry and will get back to you shortly with a detailed response."
+        return fallback_response, 0.5, "Fallback response due to AI service error"
     
     def update_knowledge_base(self, question: str, answer: str, category: str, db: Session):
         """Add new knowledge base item and update index"""
@@ -241,6 +619,7 @@ Please provide a professional, empathetic response that addresses their needs.""
         )
         db.add(new_item)
         db.commit()
+        db.refresh(new_item)
         
-        # Rebuild index
-        self.build_knowledge_base_index(db)
+        # Embed only the new item instead of rebuilding the whole index
+        self.upsert_knowledge_base_item(new_item, db)
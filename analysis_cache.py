@@ -0,0 +1,129 @@
+"""
+AI Analysis Cache
+Persists LLM results keyed by a hash of the normalised email content, model
+and prompt version so repeated emails reuse earlier results without an API call.
+"""
+
+import hashlib
+import json
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from config import settings
+from database import AICacheEntry, SessionLocal
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_content(text: str) -> str:
+    """Normalise text so trivially different copies of an email share a cache key"""
+    return _WHITESPACE_PATTERN.sub(' ', (text or '').lower()).strip()
+
+
+class AnalysisCache:
+    """Database-backed cache with TTL expiry, LRU eviction and hit/miss counters"""
+
+    def __init__(self, ttl_seconds: int, max_entries: int, enabled: bool = True):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._counters = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind: str, model: str, prompt_version: str, content: str, **context) -> str:
+        """Build the cache key; context holds any other prompt inputs that change the result"""
+        parts = [kind, model, prompt_version, normalize_content(content)]
+        parts.extend(f"{name}={context[name]}" for name in sorted(context))
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Return the cached value, or None on a miss or expired entry"""
+        if not self.enabled:
+            return None
+
+        db = SessionLocal()
+        try:
+            entry = db.query(AICacheEntry).filter(AICacheEntry.cache_key == key).first()
+            now = datetime.utcnow()
+
+            if entry is not None and now - entry.created_at > self.ttl:
+                db.delete(entry)
+                db.commit()
+                entry = None
+
+            if entry is None:
+                self._count(kind, 'misses')
+                return None
+
+            entry.last_accessed = now
+            db.commit()
+            self._count(kind, 'hits')
+            return json.loads(entry.value)
+        except Exception as e:
+            print(f"Error reading AI cache: {e}")
+            db.rollback()
+            return None
+        finally:
+            db.close()
+
+    def set(self, kind: str, key: str, value: Any):
+        """Store a value, evicting the least recently used entries beyond max_entries"""
+        if not self.enabled:
+            return
+
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            entry = db.query(AICacheEntry).filter(AICacheEntry.cache_key == key).first()
+            if entry is None:
+                entry = AICacheEntry(cache_key=key, kind=kind)
+                db.add(entry)
+            entry.value = json.dumps(value)
+            entry.created_at = now
+            entry.last_accessed = now
+            db.commit()
+
+            overflow = db.query(AICacheEntry).count() - self.max_entries
+            if overflow > 0:
+                stale_ids = [
+                    row[0] for row in db.query(AICacheEntry.id)
+                    .order_by(AICacheEntry.last_accessed.asc())
+                    .limit(overflow)
+                ]
+                db.query(AICacheEntry).filter(AICacheEntry.id.in_(stale_ids)).delete(synchronize_session=False)
+                db.commit()
+                with self._lock:
+                    self._evictions += len(stale_ids)
+        except Exception as e:
+            print(f"Error writing AI cache: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
+    def _count(self, kind: str, outcome: str):
+        with self._lock:
+            self._counters[kind][outcome] += 1
+
+    def stats(self) -> Dict:
+        """Hit/miss counters per result kind since process start"""
+        with self._lock:
+            kinds = {}
+            for kind, counts in self._counters.items():
+                lookups = counts['hits'] + counts['misses']
+                kinds[kind] = {
+                    **counts,
+                    'hit_rate': round(counts['hits'] / lookups, 3) if lookups else 0.0
+                }
+            return {'enabled': self.enabled, 'evictions': self._evictions, 'kinds': kinds}
+
+
+analysis_cache = AnalysisCache(
+    ttl_seconds=settings.AI_CACHE_TTL_SECONDS,
+    max_entries=settings.AI_CACHE_MAX_ENTRIES,
+    enabled=settings.AI_CACHE_ENABLED
+)
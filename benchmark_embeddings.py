@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Embedding Backend Benchmark
+Measures encode throughput of each embedding backend (PyTorch, PyTorch int8,
+ONNX Runtime fp32/int8) and the cosine similarity of its vectors to the
+eager PyTorch reference, to pick EMBEDDING_BACKEND, EMBEDDING_THREADS and
+EMBEDDING_BATCH_SIZE.
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from config import settings
+from embedding_backends import EMBEDDING_BACKENDS, load_embedding_model
+
+_SUBJECTS = ["my account", "the invoice", "order #48213", "the mobile app", "two-factor login",
+             "the API key", "my subscription", "the export to CSV", "password reset", "the dashboard"]
+_PROBLEMS = ["is not working", "shows error ERR-502", "was charged twice", "keeps timing out",
+             "cannot be found", "stopped syncing yesterday", "is much slower than usual", "needs an update"]
+_ASKS = ["Can you help?", "Please fix this asap.", "What should I do next?",
+         "Is there a workaround?", "I need this resolved before Friday."]
+
+
+def sample_texts(n_texts: int, seed: int = 0):
+    """Support-email-like sentences of varying length"""
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n_texts):
+        sentences = [f"Hi, {rng.choice(_SUBJECTS)} {rng.choice(_PROBLEMS)}." for _ in range(rng.randint(1, 4))]
+        texts.append(" ".join(sentences + [rng.choice(_ASKS)]))
+    return texts
+
+
+def encode_throughput(model, texts, repeats: int):
+    """Best-of-repeats texts/second and the embeddings from the last run"""
+    model.encode(texts[:8])  # warm up
+    best = 0.0
+    embeddings = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embeddings = model.encode(texts)
+        best = max(best, len(texts) / (time.perf_counter() - start))
+    return best, embeddings
+
+
+def cosine_parity(embeddings: np.ndarray, reference: np.ndarray):
+    """Mean and minimum row-wise cosine similarity between two embedding matrices"""
+    a = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    b = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cosines = (a * b).sum(axis=1)
+    return float(cosines.mean()), float(cosines.min())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends")
+    parser.add_argument('--model', default=settings.EMBEDDING_MODEL)
+    parser.add_argument('--backends', nargs='+', choices=EMBEDDING_BACKENDS, default=list(EMBEDDING_BACKENDS))
+    parser.add_argument('--texts', type=int, default=1000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[settings.EMBEDDING_THREADS],
+                        help="0 keeps the runtime default")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[settings.EMBEDDING_BATCH_SIZE])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--cache-dir', default=settings.EMBEDDING_CACHE_DIR)
+    args = parser.parse_args()
+
+    texts = sample_texts(args.texts)
+    print(f"{args.model}: {len(texts)} texts, best of {args.repeats} runs\n")
+
+    reference_model = load_embedding_model(args.model, backend='torch', cache_dir=args.cache_dir)
+    reference = reference_model.encode(texts)
+    del reference_model
+
+    for backend in args.backends:
+        for threads in args.threads:
+            for batch_size in args.batch_sizes:
+                model = load_embedding_model(args.model, backend=backend, threads=threads,
+                                             batch_size=batch_size, cache_dir=args.cache_dir)
+                throughput, embeddings = encode_throughput(model, texts, args.repeats)
+                mean_cosine, min_cosine = cosine_parity(embeddings, reference)
+                print(f"{backend:<11} threads={threads or 'default':<8} batch={batch_size:<4} "
+                      f"{throughput:9.1f} texts/s   cosine vs torch mean {mean_cosine:.5f} min {min_cosine:.5f}")
+                del model
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Knowledge Base Index Benchmark
+Compares recall, query latency and memory of the approximate index types
+(HNSW, IVF) and quantization modes (sq8, pq) against exact float32 flat
+search, to pick KB_INDEX_TYPE, KB_INDEX_QUANTIZATION and their tuning knobs
+before importing a large knowledge base.
+"""
+
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from vector_index import INDEX_TYPES, QUANTIZATION_MODES, create_index, set_search_params
+
+
+def synthetic_embeddings(n_vectors: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """Clustered unit vectors with low intrinsic dimension, closer to sentence embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    n_topics = max(1, n_vectors // 500)
+    latent_dimension = min(dimension, 64)
+    topics = rng.standard_normal((n_topics, latent_dimension)).astype('float32')
+    latent = topics[rng.integers(0, n_topics, n_vectors)]
+    latent += 0.5 * rng.standard_normal((n_vectors, latent_dimension)).astype('float32')
+    projection = rng.standard_normal((latent_dimension, dimension)).astype('float32')
+    vectors = latent @ projection
+    vectors += 0.1 * np.abs(vectors).mean() * rng.standard_normal((n_vectors, dimension)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def time_queries(index, queries: np.ndarray, top_k: int):
+    """Search one query at a time, as the RAG path does, and return ids and latencies in ms"""
+    results = np.empty((len(queries), top_k), dtype='int64')
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, I = index.search(query.reshape(1, -1), top_k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        results[i] = I[0]
+    return results, latencies
+
+
+def recall_at_k(results: np.ndarray, ground_truth: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours that the approximate search found"""
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(results, ground_truth))
+    return hits / ground_truth.size
+
+
+def memory_per_million(index) -> float:
+    """Serialised index size scaled to one million vectors, in MB"""
+    return len(faiss.serialize_index(index)) / index.ntotal * 1_000_000 / 2 ** 20
+
+
+def report(label: str, build_seconds: float, memory_mb: float, latencies: np.ndarray, recall: float):
+    print(f"{label:<30} build {build_seconds:7.1f}s   {memory_mb:8.1f} MB/1M   "
+          f"p50 {np.percentile(latencies, 50):7.3f}ms   p95 {np.percentile(latencies, 95):7.3f}ms   "
+          f"recall {recall:.3f}")
+
+
+def run_benchmark(n_vectors: int, dimension: int, n_queries: int, top_k: int, index_types,
+                  quantization_modes, ef_search_values, nprobe_values, hnsw_m: int, ivf_nlist: int, pq_m: int):
+    print(f"Generating {n_vectors} vectors of dimension {dimension}...")
+    data = synthetic_embeddings(n_vectors + n_queries, dimension)
+    embeddings, queries = data[:n_vectors], data[n_vectors:]
+    ids = np.arange(n_vectors, dtype='int64')
+
+    print(f"\n{n_queries} single-vector queries, recall@{top_k} against exact float32 search\n")
+
+    exact = create_index('flat', embeddings)
+    exact.add_with_ids(embeddings, ids)
+    ground_truth, _ = time_queries(exact, queries, top_k)
+
+    for index_type in index_types:
+        for quantization in quantization_modes:
+            start = time.perf_counter()
+            index = create_index(index_type, embeddings, quantization=quantization,
+                                 hnsw_m=hnsw_m, ivf_nlist=ivf_nlist, pq_m=pq_m)
+            index.add_with_ids(embeddings, ids)
+            build_seconds = time.perf_counter() - start
+            memory_mb = memory_per_million(index)
+
+            label = f"{index_type}/{quantization}"
+            if index_type == 'hnsw':
+                settings = [(f"{label} efSearch={ef}", {'hnsw_ef_search': ef}) for ef in ef_search_values]
+            elif index_type == 'ivf':
+                label = f"{label} nlist={index.nlist}"
+                settings = [(f"{label} nprobe={nprobe}", {'ivf_nprobe': nprobe}) for nprobe in nprobe_values]
+            else:
+                settings = [(label, {})]
+
+            for setting_label, params in settings:
+                set_search_params(index, **params)
+                results, latencies = time_queries(index, queries, top_k)
+                report(setting_label, build_seconds, memory_mb, latencies, recall_at_k(results, ground_truth))
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark knowledge base index types")
+    parser.add_argument('--vectors', type=int, default=100000, help="Knowledge base size")
+    parser.add_argument('--dimension', type=int, default=384, help="Embedding dimension (384 for all-MiniLM-L6-v2)")
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--index-types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument('--quantization', nargs='+', choices=QUANTIZATION_MODES, default=list(QUANTIZATION_MODES))
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--ivf-nlist', type=int, default=0, help="0 picks about 4 * sqrt(vectors)")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--pq-m', type=int, default=48, help="PQ bytes per vector")
+    args = parser.parse_args()
+
+    run_benchmark(args.vectors, args.dimension, args.queries, args.top_k, args.index_types, args.quantization,
+                  args.ef_search, args.nprobe, args.hnsw_m, args.ivf_nlist, args.pq_m)
+
+
+if __name__ == "__main__":
+    main()
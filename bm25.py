@@ -0,0 +1,125 @@
+"""
+BM25 Keyword Retrieval
+In-memory inverted index over knowledge base items, scored with Okapi BM25.
+Catches exact product names, error codes and order numbers that dense
+retrieval misses, and needs no embedding model.
+"""
+
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Runs of letters/digits, keeping joined codes such as "err-404" or "v2.1" together
+_TOKEN_PATTERN = re.compile(r'[a-z0-9]+(?:[-_.][a-z0-9]+)*')
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'for', 'from', 'has',
+    'have', 'how', 'i', 'if', 'in', 'is', 'it', 'my', 'of', 'on', 'or', 'our', 'so', 'that',
+    'the', 'their', 'this', 'to', 'was', 'we', 'what', 'when', 'will', 'with', 'you', 'your',
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; joined codes are indexed whole and also by their parts"""
+    terms = []
+    for token in _TOKEN_PATTERN.findall((text or '').lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = re.split(r'[-_.]', token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOPWORDS)
+    return terms
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[int]], k: int = 60) -> List[int]:
+    """Merge ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item_id: scores[item_id], reverse=True)
+
+
+class BM25Index:
+    """Inverted index of term -> {document id: term frequency}"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_lengths: Dict[int, int] = {}
+        # Distinct terms per document, so removal only touches its own postings
+        self.doc_terms: Dict[int, List[str]] = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    @property
+    def size(self) -> int:
+        return len(self.doc_lengths)
+
+    def build(self, documents: Dict[int, str]):
+        """Index every document from scratch"""
+        with self._lock:
+            self.postings = {}
+            self.doc_lengths = {}
+            self.doc_terms = {}
+            self._total_length = 0
+            for doc_id, text in documents.items():
+                self._add(doc_id, text)
+
+    def _add(self, doc_id: int, text: str):
+        terms = tokenize(text)
+        frequencies = Counter(terms)
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+        self.doc_terms[doc_id] = list(frequencies)
+        self.doc_lengths[doc_id] = len(terms)
+        self._total_length += len(terms)
+
+    def upsert(self, doc_id: int, text: str):
+        """Index a new document or re-index an edited one"""
+        with self._lock:
+            self.remove(doc_id)
+            self._add(doc_id, text)
+
+    def remove(self, doc_id: int) -> bool:
+        """Drop a document from the index"""
+        with self._lock:
+            if doc_id not in self.doc_lengths:
+                return False
+
+            self._total_length -= self.doc_lengths.pop(doc_id)
+            for term in self.doc_terms.pop(doc_id):
+                documents = self.postings[term]
+                del documents[doc_id]
+                if not documents:
+                    del self.postings[term]
+            return True
+
+    def search(self, query: str, top_k: int, allowed_ids: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """Return (document id, score) pairs for the best-matching documents, optionally only among allowed_ids"""
+        with self._lock:
+            if not self.doc_lengths:
+                return []
+
+            n_documents = len(self.doc_lengths)
+            average_length = self._total_length / n_documents or 1.0
+            scores: Dict[int, float] = {}
+            for term in set(tokenize(query)):
+                documents = self.postings.get(term)
+                if not documents:
+                    continue
+                idf = math.log(1 + (n_documents - len(documents) + 0.5) / (len(documents) + 0.5))
+                for doc_id, frequency in documents.items():
+                    if allowed_ids is not None and doc_id not in allowed_ids:
+                        continue
+                    length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / average_length
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (
+                        frequency + self.k1 * length_norm
+                    )
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Bulk Knowledge Base Ingestion
+Imports a large knowledge base (e.g. historical resolved tickets) and embeds
+it in chunks across a process pool, writing each chunk's vectors to the
+database as soon as it is encoded. Interrupted runs resume where they
+stopped: imported records are checkpointed and rows that already carry a
+current embedding are skipped.
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from config import settings
+from database import KnowledgeBase, SessionLocal, ensure_schema
+from embedding_backends import embedding_model_id, load_embedding_model
+from vector_index import embedding_to_blob, item_content_hash
+
+# Embedding model of this worker process, see _init_worker
+_worker_model = None
+
+
+def _init_worker(threads: int, batch_size: int):
+    global _worker_model
+    _worker_model = load_embedding_model(
+        settings.EMBEDDING_MODEL,
+        backend=settings.EMBEDDING_BACKEND,
+        threads=threads,
+        batch_size=batch_size,
+        cache_dir=settings.EMBEDDING_CACHE_DIR
+    )
+
+
+def _encode_chunk(item_ids: List[int], texts: List[str]) -> Tuple[List[int], List[bytes]]:
+    embeddings = _worker_model.encode(texts)
+    return item_ids, [embedding_to_blob(embedding) for embedding in embeddings]
+
+
+def read_items(path: str) -> Iterator[Dict[str, str]]:
+    """Stream question/answer/category records from a .jsonl or .csv file"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _checkpoint_path(path: str) -> str:
+    return f"{path}.progress"
+
+
+def _load_checkpoint(path: str) -> Optional[Dict[str, int]]:
+    try:
+        with open(_checkpoint_path(path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_checkpoint(path: str, checkpoint: Dict[str, int]):
+    tmp_path = f"{_checkpoint_path(path)}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, _checkpoint_path(path))
+
+
+def import_items(path: str, chunk_size: int) -> int:
+    """Insert the file's records into the knowledge base in chunks, resuming after the last checkpoint"""
+    checkpoint = _load_checkpoint(path)
+    db = SessionLocal()
+    try:
+        if checkpoint is None:
+            # Fresh run: rows already in the table predate this import, so only
+            # rows added from here on count towards the file's records
+            baseline = db.query(func.max(KnowledgeBase.id)).scalar() or 0
+            checkpoint = {'records': 0, 'last_id': baseline}
+            _save_checkpoint(path, checkpoint)
+
+        # Rows committed after the last checkpoint was written belong to the next records
+        committed = db.query(func.count(KnowledgeBase.id)).filter(
+            KnowledgeBase.id > checkpoint['last_id']
+        ).scalar()
+        skip = checkpoint['records'] + committed
+        imported = 0
+
+        chunk = []
+        for position, record in enumerate(read_items(path)):
+            if position < skip:
+                continue
+            chunk.append(KnowledgeBase(
+                question=record.get('question', ''),
+                answer=record.get('answer', ''),
+                category=record.get('category') or 'general'
+            ))
+            if len(chunk) >= chunk_size:
+                imported += _commit_chunk(db, chunk, path, position + 1)
+                chunk = []
+        if chunk:
+            imported += _commit_chunk(db, chunk, path, skip + imported + len(chunk))
+
+        if skip:
+            print(f"Skipped {skip} records imported by an earlier run")
+        return imported
+    finally:
+        db.close()
+
+
+def _commit_chunk(db, chunk: List[KnowledgeBase], path: str, records: int) -> int:
+    db.add_all(chunk)
+    db.flush()
+    last_id = max(item.id for item in chunk)
+    db.commit()
+    _save_checkpoint(path, {'records': records, 'last_id': last_id})
+    print(f"Imported {records} records")
+    return len(chunk)
+
+
+def stale_chunks(db, chunk_size: int, model_id: str) -> Iterator[Tuple[List[int], List[str], Dict[int, str]]]:
+    """Yield (ids, texts, content hashes) of rows whose embedding is missing or outdated, in id order"""
+    last_id = 0
+    while True:
+        rows = db.query(
+            KnowledgeBase.id, KnowledgeBase.question, KnowledgeBase.answer,
+            KnowledgeBase.embedding_model, KnowledgeBase.content_hash,
+            KnowledgeBase.embedding.is_(None)
+        ).filter(KnowledgeBase.id > last_id).order_by(KnowledgeBase.id).limit(chunk_size).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+
+        ids, texts, hashes = [], [], {}
+        for item_id, question, answer, embedding_model, content_hash, missing in rows:
+            item_hash = item_content_hash(item_id, question, answer)
+            if missing or embedding_model != model_id or content_hash != item_hash:
+                ids.append(item_id)
+                # Same text AIService embeds, see AIService._knowledge_base_text
+                texts.append(f"{question} {answer}")
+                hashes[item_id] = item_hash
+        if ids:
+            yield ids, texts, hashes
+
+
+def embed_items(chunk_size: int, workers: int, threads: int, batch_size: int) -> int:
+    """Encode every stale row across a process pool, writing vectors back chunk by chunk"""
+    model_id = embedding_model_id(settings.EMBEDDING_MODEL, settings.EMBEDDING_BACKEND)
+    db = SessionLocal()
+    embedded = 0
+    started = time.perf_counter()
+
+    # spawn: forked PyTorch/ONNX thread pools can deadlock in the children
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads, batch_size)) as pool:
+        pending = {}
+        chunks = stale_chunks(db, chunk_size, model_id)
+        try:
+            while True:
+                # Keep a couple of chunks queued per worker, never the whole table
+                while len(pending) < workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    ids, texts, hashes = chunk
+                    pending[pool.submit(_encode_chunk, ids, texts)] = hashes
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    hashes = pending.pop(future)
+                    ids, blobs = future.result()
+                    db.bulk_update_mappings(KnowledgeBase, [
+                        {'id': item_id, 'embedding': blob, 'embedding_model': model_id,
+                         'content_hash': hashes[item_id]}
+                        for item_id, blob in zip(ids, blobs)
+                    ])
+                    db.commit()
+                    embedded += len(ids)
+                    rate = embedded / (time.perf_counter() - started)
+                    print(f"Embedded {embedded} items ({rate:.0f}/s)")
+        finally:
+            chunks.close()
+            db.close()
+
+    return embedded
+
+
+def rebuild_index():
+    """Build and save the FAISS snapshot from the stored embeddings"""
+    from ai_service import AIService
+
+    db = SessionLocal()
+    try:
+        AIService().build_knowledge_base_index(db)
+    finally:
+        db.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Import and embed a large knowledge base")
+    parser.add_argument('--input', help="Optional .jsonl or .csv file with question, answer and category")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="Rows per database read, write and encode task")
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count // 2), help="Encoding processes")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="Inference threads per worker; 0 splits the CPUs between the workers")
+    parser.add_argument('--batch-size', type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--skip-index', action='store_true', help="Only store embeddings, don't rebuild the index")
+    args = parser.parse_args(argv)
+
+    ensure_schema()
+
+    if args.input:
+        imported = import_items(args.input, args.chunk_size)
+        print(f"Imported {imported} new knowledge base items")
+
+    threads = args.threads or max(1, cpu_count // args.workers)
+    embedded = embed_items(args.chunk_size, args.workers, threads, args.batch_size)
+    print(f"Embedded {embedded} knowledge base items")
+
+    if not args.skip_index:
+        print("Building knowledge base index...")
+        rebuild_index()
+        print("Knowledge base index built successfully!")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ with realistic sample data that showcases the system's capabilities.
 import json
 import time
 from datetime import datetime, timedelta
-from database import get_db, Email, EmailAnalytics, KnowledgeBase
+from database import get_db, Email, EmailAnalytics, KnowledgeBase, priority_queue_key
 from ai_service import AIService
 from email_service import EmailService
 
@@ -102,6 +102,7 @@ def create_comprehensive_sample_emails():
             # Analyze email using AI service
             sentiment = ai_service.analyze_sentiment(email_data['body'])
             priority = ai_service.detect_priority(email_data['body'], email_data['subject'])
+            urgency_score = ai_service.urgency_score(email_data['body'], email_data['subject'])
             category = ai_service.categorize_email(email_data['subject'], email_data['body'])
             extracted_info = ai_service.extract_information(email_data['body'])
             
@@ -114,6 +115,8 @@ def create_comprehensive_sample_emails():
                 received_date=email_data['received_date'],
                 sentiment=sentiment,
                 priority=priority,
+                urgency_score=urgency_score,
+                queue_key=priority_queue_key(priority, urgency_score, email_data['received_date']),
                 category=category,
                 extracted_info=json.dumps(extracted_info),
                 is_processed=True,
@@ -7,6 +7,21 @@ class Settings:
     # OpenAI Configuration
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     OPENAI_MODEL: str = os.getenv("OPENAI_MODEL", "gpt-4")
+    # Leave empty for api.openai.com; set to e.g. http://127.0.0.1:8100/v1 for mock_llm_server.py
+    OPENAI_API_BASE: str = os.getenv("OPENAI_API_BASE", "")
+    OPENAI_MAX_CONCURRENCY: int = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+    OPENAI_MAX_RETRIES: int = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+    OPENAI_TIMEOUT_SECONDS: float = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+    OPENAI_BACKOFF_BASE_SECONDS: float = float(os.getenv("OPENAI_BACKOFF_BASE_SECONDS", "0.5"))
+    OPENAI_BACKOFF_MAX_SECONDS: float = float(os.getenv("OPENAI_BACKOFF_MAX_SECONDS", "20"))
+    # Consecutive failed attempts that open the circuit breaker, and how long it stays open before a probe
+    OPENAI_CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("OPENAI_CIRCUIT_FAILURE_THRESHOLD", "5"))
+    OPENAI_CIRCUIT_RESET_SECONDS: float = float(os.getenv("OPENAI_CIRCUIT_RESET_SECONDS", "30"))
+    # Maximum prompt size for response generation, in tokens
+    PROMPT_TOKEN_BUDGET: int = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+    SENTIMENT_BATCH_SIZE: int = int(os.getenv("SENTIMENT_BATCH_SIZE", "20"))
+    # Emails the local classifier scores below this confidence are sent to the LLM
+    LOCAL_SENTIMENT_CONFIDENCE_THRESHOLD: float = float(os.getenv("LOCAL_SENTIMENT_CONFIDENCE_THRESHOLD", "0.65"))
     
     # Email Configuration
     EMAIL_HOST: str = os.getenv("EMAIL_HOST", "imap.gmail.com")
@@ -14,6 +29,9 @@ class Settings:
     EMAIL_USERNAME: str = os.getenv("EMAIL_USERNAME", "")
     EMAIL_PASSWORD: str = os.getenv("EMAIL_PASSWORD", "")
     EMAIL_USE_SSL: bool = os.getenv("EMAIL_USE_SSL", "true").lower() == "true"
+    EMAIL_MAILBOX: str = os.getenv("EMAIL_MAILBOX", "INBOX")
+    # Syncs that may fail on the same message before it is skipped
+    EMAIL_SYNC_MAX_ATTEMPTS: int = int(os.getenv("EMAIL_SYNC_MAX_ATTEMPTS", "3"))
     
     # Database Configuration
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./email_assistant.db")
@@ -28,10 +46,62 @@ class Settings:
     ALGORITHM: str = os.getenv("ALGORITHM", "HS256")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
     
+    # Near-duplicate clustering
+    NEAR_DUPLICATE_THRESHOLD: float = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+    NEAR_DUPLICATE_WINDOW_HOURS: int = int(os.getenv("NEAR_DUPLICATE_WINDOW_HOURS", "72"))
+    
+    # AI Result Cache
+    AI_CACHE_ENABLED: bool = os.getenv("AI_CACHE_ENABLED", "true").lower() == "true"
+    AI_CACHE_TTL_SECONDS: int = int(os.getenv("AI_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+    AI_CACHE_MAX_ENTRIES: int = int(os.getenv("AI_CACHE_MAX_ENTRIES", "10000"))
+    
+    # Knowledge Base / RAG Configuration
+    EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+    # torch, torch-int8, onnx or onnx-int8; 0 threads keeps the runtime default
+    EMBEDDING_BACKEND: str = os.getenv("EMBEDDING_BACKEND", "torch")
+    EMBEDDING_THREADS: int = int(os.getenv("EMBEDDING_THREADS", "0"))
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+    EMBEDDING_CACHE_DIR: str = os.getenv("EMBEDDING_CACHE_DIR", "./model_cache")
+    KB_INDEX_DIR: str = os.getenv("KB_INDEX_DIR", "./kb_index")
+    # flat is exact; hnsw and ivf are approximate and meant for large knowledge bases
+    KB_INDEX_TYPE: str = os.getenv("KB_INDEX_TYPE", "flat")
+    KB_HNSW_M: int = int(os.getenv("KB_HNSW_M", "32"))
+    KB_HNSW_EF_CONSTRUCTION: int = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "200"))
+    KB_HNSW_EF_SEARCH: int = int(os.getenv("KB_HNSW_EF_SEARCH", "64"))
+    # 0 picks about 4 * sqrt(knowledge base size) lists
+    KB_IVF_NLIST: int = int(os.getenv("KB_IVF_NLIST", "0"))
+    KB_IVF_NPROBE: int = int(os.getenv("KB_IVF_NPROBE", "16"))
+    # none keeps float32 vectors; sq8 stores 1 byte per dimension, pq stores KB_PQ_M bytes per vector
+    KB_INDEX_QUANTIZATION: str = os.getenv("KB_INDEX_QUANTIZATION", "none")
+    KB_PQ_M: int = int(os.getenv("KB_PQ_M", "48"))
+    # hybrid fuses BM25 and vector results; bm25 never loads the embedding model
+    KB_RETRIEVAL_MODE: str = os.getenv("KB_RETRIEVAL_MODE", "hybrid")
+    KB_RETRIEVAL_CANDIDATES: int = int(os.getenv("KB_RETRIEVAL_CANDIDATES", "20"))
+    KB_RRF_K: int = int(os.getenv("KB_RRF_K", "60"))
+    
     # Support Keywords for filtering
     SUPPORT_KEYWORDS = ["support", "query", "request", "help", "issue", "problem", "assistance"]
     
     # Urgency Keywords
     URGENCY_KEYWORDS = ["immediately", "critical", "urgent", "asap", "cannot access", "broken", "down"]
+    
+    # Time-sensitive phrases, matched as whole words and counted per occurrence
+    TIME_SENSITIVE_KEYWORDS = [
+        "immediately", "asap", "urgent", "critical",
+        "cannot access", "broken", "down", "not working",
+        "emergency", "help needed", "stuck"
+    ]
+    
+    # Emotional intensity keywords
+    EMOTIONAL_KEYWORDS = ["frustrated", "angry", "desperate", "helpless", "urgent"]
+    
+    # Category keywords, in tie-break order
+    CATEGORY_KEYWORDS = {
+        "support": ["support", "help", "assistance", "issue", "problem"],
+        "query": ["question", "inquiry", "ask", "wondering"],
+        "request": ["request", "need", "want", "require"],
+        "complaint": ["complaint", "dissatisfied", "unhappy", "disappointed"],
+        "feedback": ["feedback", "suggestion", "improvement", "review"]
+    }
 
 settings = Settings()
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, Float
+from sqlalchemy import create_engine, inspect, text, Column, Index, BigInteger, Integer, String, Text, DateTime, Boolean, Float, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 from datetime import datetime
+import calendar
 import aiosqlite
 from config import settings
 
@@ -19,14 +20,66 @@ class Email(Base):
     received_date = Column(DateTime, default=datetime.utcnow)
     sentiment = Column(String)  # positive, negative, neutral
     priority = Column(String)  # urgent, not_urgent
+    urgency_score = Column(Integer)  # raw keyword score behind priority
+    queue_key = Column(BigInteger)  # see priority_queue_key
     category = Column(String)  # support, query, request, help
     is_processed = Column(Boolean, default=False)
     is_responded = Column(Boolean, default=False)
     response_generated = Column(Text)
     response_sent = Column(Boolean, default=False)
     extracted_info = Column(Text)  # JSON string of extracted information
+    cluster_id = Column(Integer, index=True)  # near-duplicate cluster, see EmailCluster
+    # Last response generation, see llm_metrics.CallTrace
+    ai_model = Column(String)
+    ai_latency_ms = Column(Float)
+    ai_prompt_tokens = Column(Integer)
+    ai_completion_tokens = Column(Integer)
+    ai_retries = Column(Integer)
+    ai_outcome = Column(String)  # ok, error, fallback, cached, cluster
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    
+    # Serves the priority queue straight from the index, see EmailService.get_priority_queue
+    __table_args__ = (Index('ix_emails_queue', 'is_processed', 'is_responded', 'queue_key'),)
+
+# Room for received-date seconds in the low digits of queue_key (dates up to the year 2286)
+QUEUE_KEY_TIME_SPAN = 10 ** 10
+# Room for urgency scores above them, and for the priority tier above those
+QUEUE_KEY_SCORE_SPAN = 10 ** 6
+QUEUE_KEY_TIER_SPAN = QUEUE_KEY_SCORE_SPAN * QUEUE_KEY_TIME_SPAN
+
+# Priority tiers in queue_key; the priority, including a manual override, outranks any score
+PRIORITY_TIERS = {'not_urgent': 0, 'urgent': 1}
+
+def priority_queue_key(priority: str, urgency_score: int, received_date: datetime = None) -> int:
+    """Sort key for the priority queue: urgent first, then higher urgency score, then oldest first"""
+    epoch = calendar.timegm(received_date.timetuple()) if received_date else QUEUE_KEY_TIME_SPAN - 1
+    epoch = min(max(epoch, 0), QUEUE_KEY_TIME_SPAN - 1)
+    score = min(max(int(urgency_score or 0), 0), QUEUE_KEY_SCORE_SPAN - 1)
+    return (PRIORITY_TIERS.get(priority, 0) * QUEUE_KEY_TIER_SPAN
+            + score * QUEUE_KEY_TIME_SPAN + (QUEUE_KEY_TIME_SPAN - 1 - epoch))
+
+class EmailCluster(Base):
+    __tablename__ = "email_clusters"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    representative_email_id = Column(Integer)  # first email of the cluster
+    size = Column(Integer, default=1)
+    draft = Column(Text)  # shared AI draft, personalised per sender
+    draft_sender = Column(String)  # display name the draft was written for
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class MailboxSyncState(Base):
+    __tablename__ = "mailbox_sync_state"
+    
+    mailbox = Column(String, primary_key=True)
+    # UIDVALIDITY and UIDs are unsigned 32-bit values
+    uidvalidity = Column(BigInteger)  # UIDs are only comparable while this stays the same
+    last_uid = Column(BigInteger, default=0)  # highest UID already fetched
+    failed_uid = Column(BigInteger)  # message the checkpoint is held back for
+    failed_attempts = Column(Integer, default=0)  # syncs that failed on failed_uid
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class EmailAnalytics(Base):
     __tablename__ = "email_analytics"
@@ -48,15 +101,46 @@ class KnowledgeBase(Base):
     question = Column(String, index=True)
     answer = Column(Text)
     category = Column(String, index=True)
-    embedding = Column(Text)  # Vector embedding for RAG
+    embedding = Column(LargeBinary)  # float32 vector embedding for RAG
+    embedding_model = Column(String)  # model that produced the embedding
+    content_hash = Column(String, index=True)  # hash of the text that was embedded
     created_at = Column(DateTime, default=func.now())
 
+class AICacheEntry(Base):
+    __tablename__ = "ai_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True)  # hash of kind, model, prompt version and content
+    kind = Column(String, index=True)  # sentiment, response
+    value = Column(Text)  # JSON encoded result
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+
 # Database engine and session
 engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def ensure_schema():
+    """Create tables and add columns introduced since an existing database was created"""
+    Base.metadata.create_all(bind=engine)
+    
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        
+        # create_all skips indexes on tables that already exist
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
 # Create tables
-Base.metadata.create_all(bind=engine)
+ensure_schema()
 
 def get_db():
     db = SessionLocal()
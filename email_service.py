@@ -4,20 +4,44 @@ import json
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 import re
 from config import settings
-from database import Email, EmailAnalytics, get_db
+from database import (
+    QUEUE_KEY_TIER_SPAN, Email, EmailAnalytics, EmailCluster, MailboxSyncState, SessionLocal, get_db,
+    priority_queue_key
+)
 from ai_service import AIService
+from keyword_matcher import KeywordHits
+from llm_client import LLMError
+from llm_metrics import CallTrace, llm_metrics
+from singleflight import AsyncSingleFlight, SingleFlight
+from near_duplicates import NearDuplicateDetector, personalize_draft, sender_display_name
 from sqlalchemy.orm import Session
 import smtplib
 from email.mime.text import MIMEText
 
+def _decode_payload(part) -> str:
+    """Text of a message part in its declared charset, never failing on bad bytes"""
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:
+        # Unknown charset name
+        return payload.decode('utf-8', errors='replace')
+
 class EmailService:
     def __init__(self):
         self.ai_service = AIService()
         self.imap_server = None
         self.smtp_server = None
+        self.duplicate_detector = NearDuplicateDetector(
+            threshold=settings.NEAR_DUPLICATE_THRESHOLD,
+            window_seconds=settings.NEAR_DUPLICATE_WINDOW_HOURS * 3600
+        )
+        self._clusters_loaded = False
+        self._response_flight = SingleFlight()
+        self._aresponse_flight = AsyncSingleFlight()
         
     def connect_imap(self) -> bool:
         """Connect to IMAP server"""
@@ -61,29 +85,69 @@ class EmailService:
             except:
                 pass
     
-    def is_support_email(self, subject: str, body: str) -> bool:
+    def is_support_email(self, subject: str, body: str, hits: Optional[KeywordHits] = None) -> bool:
         """Check if email is support-related based on keywords"""
-        text_lower = (subject + " " + body).lower()
-        return any(keyword in text_lower for keyword in settings.SUPPORT_KEYWORDS)
+        hits = hits or self.ai_service.scan_keywords(subject, body)
+        return hits.distinct('support') > 0
+    
+    def _mailbox_uid_state(self, mailbox: str) -> Tuple[Optional[int], Optional[int]]:
+        """UIDVALIDITY and UIDNEXT of the selected mailbox"""
+        def response_int(name):
+            _, data = self.imap_server.response(name)
+            try:
+                return int(data[0])
+            except (TypeError, ValueError, IndexError):
+                return None
+        
+        uidvalidity, uidnext = response_int('UIDVALIDITY'), response_int('UIDNEXT')
+        if uidvalidity is None or uidnext is None:
+            # Not every server volunteers these on SELECT
+            _, data = self.imap_server.status(mailbox, '(UIDVALIDITY UIDNEXT)')
+            status = data[0].decode() if data and isinstance(data[0], bytes) else ''
+            match = re.search(r'UIDVALIDITY (\d+)', status)
+            uidvalidity = uidvalidity if uidvalidity is not None else (int(match.group(1)) if match else None)
+            match = re.search(r'UIDNEXT (\d+)', status)
+            uidnext = uidnext if uidnext is not None else (int(match.group(1)) if match else None)
+        return uidvalidity, uidnext
     
-    def fetch_emails(self, hours_back: int = 24) -> List[Dict]:
-        """Fetch emails from the last N hours"""
+    def fetch_emails(self, hours_back: int = 24, checkpoint: Optional[Tuple[int, int]] = None
+                     ) -> Tuple[List[Dict], Optional[Tuple[int, int]], List[int]]:
+        """Fetch support emails added since the checkpoint.
+        
+        checkpoint is the (UIDVALIDITY, last UID) of the previous sync. Without
+        one, or when the server's UIDVALIDITY changed, emails from the last N
+        hours are fetched instead. Returns the emails, the new checkpoint past
+        every message looked at, and the UIDs of messages that failed.
+        """
         if not self.connect_imap():
-            return []
+            return [], checkpoint, []
         
         try:
-            self.imap_server.select('INBOX')
+            mailbox = settings.EMAIL_MAILBOX
+            self.imap_server.select(mailbox)
+            uidvalidity, uidnext = self._mailbox_uid_state(mailbox)
             
-            # Calculate date range
-            date_since = (datetime.now() - timedelta(hours=hours_back)).strftime("%d-%b-%Y")
+            incremental = bool(checkpoint and uidvalidity is not None and checkpoint[0] == uidvalidity)
+            if incremental:
+                # Only messages added since the last sync
+                last_uid = checkpoint[1]
+                _, uid_data = self.imap_server.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+            else:
+                # First sync or the mailbox was rebuilt: old UIDs mean nothing, resync the window
+                last_uid = uidnext - 1 if uidnext else 0
+                date_since = (datetime.now() - timedelta(hours=hours_back)).strftime("%d-%b-%Y")
+                _, uid_data = self.imap_server.uid('SEARCH', None, f'(SINCE {date_since})')
             
-            # Search for emails since date
-            _, message_numbers = self.imap_server.search(None, f'(SINCE {date_since})')
+            uids = sorted(int(uid) for uid in uid_data[0].split())
+            if incremental:
+                # "n:*" always matches the newest message, even when its UID is below n
+                uids = [uid for uid in uids if uid > last_uid]
             
             emails = []
-            for num in message_numbers[0].split():
+            failed_uids = []
+            for uid in uids:
                 try:
-                    _, msg_data = self.imap_server.fetch(num, '(RFC822)')
+                    _, msg_data = self.imap_server.uid('FETCH', str(uid), '(RFC822)')
                     email_body = msg_data[0][1]
                     email_message = email.message_from_bytes(email_body)
                     
@@ -104,84 +168,196 @@ class EmailService:
                     if email_message.is_multipart():
                         for part in email_message.walk():
                             if part.get_content_type() == "text/plain":
-                                body = part.get_payload(decode=True).decode()
+                                body = _decode_payload(part)
                                 break
                     else:
-                        body = email_message.get_payload(decode=True).decode()
+                        body = _decode_payload(email_message)
                     
-                    # Check if it's a support email
-                    if self.is_support_email(subject, body):
+                    # Check if it's a support email; the hits are reused for priority and category
+                    hits = self.ai_service.scan_keywords(subject, body)
+                    if self.is_support_email(subject, body, hits):
                         emails.append({
+                            'uid': uid,
                             'message_id': message_id,
                             'sender_email': sender,
                             'subject': subject,
                             'body': body,
-                            'received_date': parsed_date
+                            'received_date': parsed_date,
+                            'keyword_hits': hits
                         })
                 
                 except Exception as e:
-                    print(f"Error processing email {num}: {e}")
+                    print(f"Error processing email UID {uid}: {e}")
+                    failed_uids.append(uid)
                     continue
             
-            return emails
+            last_uid = max([last_uid] + uids)
+            return emails, (uidvalidity, last_uid) if uidvalidity is not None else None, failed_uids
             
         except Exception as e:
             print(f"Error fetching emails: {e}")
-            return []
+            return [], checkpoint, []
         finally:
             self.disconnect()
     
-    def process_emails(self, emails: List[Dict], db: Session) -> int:
-        """Process emails using AI service and store in database"""
+    def _load_recent_clusters(self, db: Session):
+        """Seed the near-duplicate index with clusters active within the window"""
+        if self._clusters_loaded:
+            return
+        
+        since = datetime.utcnow() - timedelta(hours=settings.NEAR_DUPLICATE_WINDOW_HOURS)
+        rows = db.query(EmailCluster.id, EmailCluster.updated_at, Email.body).join(
+            Email, Email.id == EmailCluster.representative_email_id
+        ).filter(EmailCluster.updated_at >= since).all()
+        
+        for cluster_id, updated_at, body in rows:
+            seen_at = (updated_at - datetime(1970, 1, 1)).total_seconds()
+            self.duplicate_detector.add(cluster_id, self.duplicate_detector.signature(body), seen_at)
+        self._clusters_loaded = True
+    
+    def assign_cluster(self, email_record: Email, db: Session) -> EmailCluster:
+        """Put a new email into the cluster of a near-identical recent email, or start a new one"""
+        self._load_recent_clusters(db)
+        
+        signature = self.duplicate_detector.signature(email_record.body)
+        cluster_id = self.duplicate_detector.find(signature)
+        cluster = db.query(EmailCluster).filter(EmailCluster.id == cluster_id).first() if cluster_id else None
+        
+        if cluster:
+            cluster.size = (cluster.size or 1) + 1
+            cluster.updated_at = datetime.utcnow()
+        else:
+            db.flush()  # assigns email_record.id
+            cluster = EmailCluster(representative_email_id=email_record.id, size=1)
+            db.add(cluster)
+            db.flush()
+            self.duplicate_detector.add(cluster.id, signature)
+        
+        email_record.cluster_id = cluster.id
+        return cluster
+    
+    def process_emails(self, emails: List[Dict], db: Session, batch_size: int = None) -> Tuple[int, List[Dict]]:
+        """Process emails using AI service and store in database.
+        
+        Returns the number of emails stored and the emails that could not be
+        stored because processing or their batch's commit failed.
+        """
+        batch_size = batch_size or settings.SENTIMENT_BATCH_SIZE
         processed_count = 0
+        failed = []
+        seen_ids = set()
         
-        for email_data in emails:
-            try:
-                # Check if email already exists
-                existing_email = db.query(Email).filter(
-                    Email.message_id == email_data['message_id']
-                ).first()
-                
-                if existing_email:
+        for start in range(0, len(emails), batch_size):
+            batch = emails[start:start + batch_size]
+            
+            # Skip emails that already exist or repeat within this sync
+            message_ids = [email_data['message_id'] for email_data in batch]
+            seen_ids.update(
+                row[0] for row in db.query(Email.message_id).filter(Email.message_id.in_(message_ids))
+            )
+            new_emails = []
+            for email_data in batch:
+                if email_data['message_id'] in seen_ids:
                     continue
-                
-                # Analyze email using AI
-                sentiment = self.ai_service.analyze_sentiment(email_data['body'])
-                priority = self.ai_service.detect_priority(email_data['body'], email_data['subject'])
-                category = self.ai_service.categorize_email(email_data['subject'], email_data['body'])
-                extracted_info = self.ai_service.extract_information(email_data['body'])
-                
-                # Create email record
-                new_email = Email(
-                    message_id=email_data['message_id'],
-                    sender_email=email_data['sender_email'],
-                    subject=email_data['subject'],
-                    body=email_data['body'],
-                    received_date=email_data['received_date'],
-                    sentiment=sentiment,
-                    priority=priority,
-                    category=category,
-                    extracted_info=json.dumps(extracted_info),
-                    is_processed=True
-                )
-                
-                db.add(new_email)
-                processed_count += 1
-                
-            except Exception as e:
-                print(f"Error processing email {email_data.get('message_id', 'unknown')}: {e}")
+                seen_ids.add(email_data['message_id'])
+                new_emails.append(email_data)
+            
+            if not new_emails:
                 continue
+            
+            # One sentiment request and one classification pass for the whole batch
+            sentiments = self.ai_service.analyze_sentiment_batch(
+                [email_data['body'] for email_data in new_emails]
+            )
+            classification = self.ai_service.classify_batch(new_emails)
+            
+            batch_emails = []
+            for i, (email_data, sentiment) in enumerate(zip(new_emails, sentiments)):
+                try:
+                    # Analyze email using AI
+                    priority = classification['priority'][i]
+                    urgency_score = int(classification['urgency_score'][i])
+                    category = classification['category'][i]
+                    extracted_info = self.ai_service.extract_information(email_data['body'])
+                    
+                    # Create email record
+                    new_email = Email(
+                        message_id=email_data['message_id'],
+                        sender_email=email_data['sender_email'],
+                        subject=email_data['subject'],
+                        body=email_data['body'],
+                        received_date=email_data['received_date'],
+                        sentiment=sentiment,
+                        priority=priority,
+                        urgency_score=urgency_score,
+                        queue_key=priority_queue_key(priority, urgency_score, email_data['received_date']),
+                        category=category,
+                        extracted_info=json.dumps(extracted_info),
+                        is_processed=True
+                    )
+                    
+                    db.add(new_email)
+                    self.assign_cluster(new_email, db)
+                    batch_emails.append(email_data)
+                    
+                except Exception as e:
+                    print(f"Error processing email {email_data.get('message_id', 'unknown')}: {e}")
+                    failed.append(email_data)
+                    continue
+            
+            # assign_cluster's flush holds the SQLite write lock until commit; release it
+            # before the next batch's sentiment cache writes, which use their own sessions
+            try:
+                db.commit()
+                processed_count += len(batch_emails)
+            except Exception as e:
+                print(f"Error committing to database: {e}")
+                db.rollback()
+                failed.extend(batch_emails)
         
-        try:
-            db.commit()
-        except Exception as e:
-            print(f"Error committing to database: {e}")
-            db.rollback()
+        return processed_count, failed
+    
+    def _cluster_draft(self, email_record: Email, custom_prompt: Optional[str], db: Session) -> Optional[str]:
+        """Personalised copy of the email's cluster draft, if one was already generated"""
+        if custom_prompt or not email_record.cluster_id:
+            return None
+        
+        cluster = db.query(EmailCluster).filter(EmailCluster.id == email_record.cluster_id).first()
+        if not cluster or not cluster.draft:
+            return None
         
-        return processed_count
+        return personalize_draft(cluster.draft, cluster.draft_sender, email_record.sender_email)
+    
+    def _store_cluster_draft(self, email_record: Email, response: str, reasoning: str,
+                             custom_prompt: Optional[str], db: Session):
+        """Keep a freshly generated draft so the rest of the cluster can reuse it"""
+        if custom_prompt or not email_record.cluster_id or reasoning.startswith("Fallback"):
+            return
+        
+        cluster = db.query(EmailCluster).filter(EmailCluster.id == email_record.cluster_id).first()
+        if cluster and not cluster.draft:
+            cluster.draft = response
+            cluster.draft_sender = sender_display_name(email_record.sender_email)
+    
+    def _store_ai_call(self, email_record: Email, trace: CallTrace, outcome: Optional[str] = None):
+        """Record how the email's response was produced, for the API and later tuning"""
+        summary = trace.summary()
+        email_record.ai_model = summary['model']
+        email_record.ai_latency_ms = summary['latency_ms']
+        email_record.ai_prompt_tokens = summary['prompt_tokens']
+        email_record.ai_completion_tokens = summary['completion_tokens']
+        email_record.ai_retries = summary['retries']
+        email_record.ai_outcome = outcome or summary['outcome']
     
     def generate_ai_response(self, email_id: int, custom_prompt: str = None, db: Session = None) -> Optional[str]:
         """Generate AI response for a specific email"""
+        # Concurrent requests for the same email and prompt share one generation
+        return self._response_flight.do(
+            (email_id, custom_prompt or ''),
+            lambda: self._generate_ai_response(email_id, custom_prompt, db)
+        )
+    
+    def _generate_ai_response(self, email_id: int, custom_prompt: Optional[str], db: Optional[Session]) -> Optional[str]:
         if not db:
             db = next(get_db())
         
@@ -190,15 +366,23 @@ class EmailService:
             return None
         
         try:
-            response, confidence, reasoning = self.ai_service.generate_response(
-                email_record.body,
-                email_record.subject,
-                email_record.sender_email,
-                email_record.sentiment,
-                email_record.priority,
-                email_record.category,
-                custom_prompt
-            )
+            # Near-identical emails share one draft, personalised for this sender
+            with llm_metrics.trace() as trace:
+                response = self._cluster_draft(email_record, custom_prompt, db)
+                if response is None:
+                    response, confidence, reasoning = self.ai_service.generate_response(
+                        email_record.body,
+                        email_record.subject,
+                        email_record.sender_email,
+                        email_record.sentiment,
+                        email_record.priority,
+                        email_record.category,
+                        custom_prompt
+                    )
+                    self._store_cluster_draft(email_record, response, reasoning, custom_prompt, db)
+                    self._store_ai_call(email_record, trace)
+                else:
+                    self._store_ai_call(email_record, trace, outcome='cluster')
             
             # Update email record
             email_record.response_generated = response
@@ -211,6 +395,102 @@ class EmailService:
             print(f"Error generating AI response: {e}")
             return None
     
+    async def agenerate_ai_response(self, email_id: int, custom_prompt: str = None, db: Session = None) -> Optional[str]:
+        """Generate AI response for a specific email without blocking the event loop"""
+        # Concurrent requests for the same email and prompt await one shared generation
+        return await self._aresponse_flight.do(
+            (email_id, custom_prompt or ''),
+            lambda: self._agenerate_ai_response(email_id, custom_prompt, db)
+        )
+    
+    async def _agenerate_ai_response(self, email_id: int, custom_prompt: Optional[str],
+                                     db: Optional[Session]) -> Optional[str]:
+        if not db:
+            db = next(get_db())
+        
+        email_record = db.query(Email).filter(Email.id == email_id).first()
+        if not email_record:
+            return None
+        
+        try:
+            # Near-identical emails share one draft, personalised for this sender
+            with llm_metrics.trace() as trace:
+                response = self._cluster_draft(email_record, custom_prompt, db)
+                if response is None:
+                    response, confidence, reasoning = await self.ai_service.agenerate_response(
+                        email_record.body,
+                        email_record.subject,
+                        email_record.sender_email,
+                        email_record.sentiment,
+                        email_record.priority,
+                        email_record.category,
+                        custom_prompt
+                    )
+                    self._store_cluster_draft(email_record, response, reasoning, custom_prompt, db)
+                    self._store_ai_call(email_record, trace)
+                else:
+                    self._store_ai_call(email_record, trace, outcome='cluster')
+            
+            # Update email record
+            email_record.response_generated = response
+            email_record.is_processed = True
+            db.commit()
+            
+            return response
+            
+        except Exception as e:
+            print(f"Error generating AI response: {e}")
+            return None
+    
+    async def astream_ai_response(self, email_id: int, custom_prompt: str = None) -> AsyncIterator[str]:
+        """Stream an AI response for an email, saving the full text once it completes"""
+        db = SessionLocal()
+        try:
+            email_record = db.query(Email).filter(Email.id == email_id).first()
+            if not email_record:
+                return
+            
+            trace = CallTrace()
+            response = self._cluster_draft(email_record, custom_prompt, db)
+            if response is not None:
+                self._store_ai_call(email_record, trace, outcome='cluster')
+                yield response
+            else:
+                chunks = []
+                try:
+                    with llm_metrics.trace() as trace:
+                        async for delta in self.ai_service.astream_response(
+                            email_record.body,
+                            email_record.subject,
+                            email_record.sender_email,
+                            email_record.sentiment,
+                            email_record.priority,
+                            email_record.category,
+                            custom_prompt
+                        ):
+                            chunks.append(delta)
+                            yield delta
+                except LLMError as e:
+                    # A half-written draft is not worth saving; only fall back if nothing was sent
+                    if chunks:
+                        raise
+                    print(f"Error streaming AI response: {e}")
+                    llm_metrics.record_fallback('response_stream')
+                    response, _, _ = self.ai_service.fallback_response(email_record.priority, email_record.category)
+                    self._store_ai_call(email_record, trace, outcome='fallback')
+                    yield response
+                else:
+                    response = "".join(chunks).strip()
+                    self._store_cluster_draft(email_record, response, "", custom_prompt, db)
+                    self._store_ai_call(email_record, trace)
+            
+            # Update email record
+            email_record.response_generated = response
+            email_record.is_processed = True
+            db.commit()
+        finally:
+            db.close()
+    
     def send_email_response(self, email_id: int, custom_response: str = None, db: Session = None) -> bool:
         """Send email response to customer"""
         if not db:
@@ -254,15 +534,39 @@ class EmailService:
             self.disconnect()
     
     def get_priority_queue(self, db: Session) -> List[Email]:
-        """Get emails in priority order (urgent first)"""
+        """Get emails in priority order (most urgent first, oldest first within a score)"""
+        # Walks ix_emails_queue backwards instead of sorting the table
         return db.query(Email).filter(
             Email.is_processed == True,
             Email.is_responded == False
         ).order_by(
-            Email.priority.desc(),
-            Email.received_date.asc()
+            Email.queue_key.desc()
         ).all()
     
+    def backfill_urgency_scores(self, db: Session, batch_size: int = 500) -> int:
+        """Score emails stored before urgency_score existed, and key urgent ones stored
+        before queue_key carried the priority tier"""
+        # Those keys are exactly the new ones minus the tier
+        updated = db.query(Email).filter(
+            Email.priority == 'urgent', Email.queue_key < QUEUE_KEY_TIER_SPAN
+        ).update({Email.queue_key: Email.queue_key + QUEUE_KEY_TIER_SPAN}, synchronize_session=False)
+        db.commit()
+        while True:
+            emails = db.query(Email).filter(Email.queue_key.is_(None)).limit(batch_size).all()
+            if not emails:
+                return updated
+            
+            classification = self.ai_service.classify_batch(
+                [{'subject': email.subject or '', 'body': email.body or ''} for email in emails]
+            )
+            for email_record, score in zip(emails, classification['urgency_score']):
+                email_record.urgency_score = int(score)
+                email_record.queue_key = priority_queue_key(
+                    email_record.priority, email_record.urgency_score, email_record.received_date
+                )
+            db.commit()
+            updated += len(emails)
+    
     def update_analytics(self, db: Session):
         """Update email analytics for dashboard"""
         today = datetime.now().date()
@@ -322,19 +626,51 @@ class EmailService:
         
         db.commit()
     
+    def _checkpoint_uid(self, state: MailboxSyncState, checkpoint: Tuple[int, int],
+                        failed_uids: List[int]) -> int:
+        """Last UID to checkpoint: just before the first message that failed, unless
+        it has now failed EMAIL_SYNC_MAX_ATTEMPTS syncs in a row and is skipped"""
+        uidvalidity, last_uid = checkpoint
+        if state.uidvalidity != uidvalidity:
+            state.failed_uid, state.failed_attempts = None, 0
+        
+        for uid in sorted(set(failed_uids)):
+            attempts = (state.failed_attempts or 0) + 1 if uid == state.failed_uid else 1
+            if attempts < settings.EMAIL_SYNC_MAX_ATTEMPTS:
+                state.failed_uid, state.failed_attempts = uid, attempts
+                return uid - 1
+            print(f"Skipping email UID {uid} after {attempts} failed sync attempts")
+        
+        state.failed_uid, state.failed_attempts = None, 0
+        return last_uid
+    
     def sync_emails(self, hours_back: int = 24) -> Dict:
         """Main method to sync emails from server"""
         try:
+            db = next(get_db())
+            mailbox = settings.EMAIL_MAILBOX
+            state = db.query(MailboxSyncState).filter(MailboxSyncState.mailbox == mailbox).first()
+            checkpoint = (state.uidvalidity, state.last_uid) if state and state.uidvalidity is not None else None
+            
             # Fetch emails
-            emails = self.fetch_emails(hours_back)
+            emails, new_checkpoint, failed_uids = self.fetch_emails(hours_back, checkpoint)
+            
+            # Process emails
+            processed_count, failed = self.process_emails(emails, db) if emails else (0, [])
+            failed_uids += [email_data['uid'] for email_data in failed]
+            
+            # Checkpoint only after processing, so a failed sync refetches the same messages
+            if new_checkpoint:
+                state = state or MailboxSyncState(mailbox=mailbox)
+                last_uid = self._checkpoint_uid(state, new_checkpoint, failed_uids)
+                if (new_checkpoint[0], last_uid) != checkpoint or failed_uids:
+                    state.uidvalidity, state.last_uid = new_checkpoint[0], last_uid
+                    db.add(state)
+                    db.commit()
             
             if not emails:
                 return {"success": True, "message": "No new emails found", "processed": 0}
             
-            # Process emails
-            db = next(get_db())
-            processed_count = self.process_emails(emails, db)
-            
             # Update analytics
             self.update_analytics(db)
             
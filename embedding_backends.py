@@ -0,0 +1,175 @@
+"""
+Embedding Model Backends
+Runs the sentence embedding model in eager PyTorch (the default), PyTorch with
+dynamic int8 quantization, or ONNX Runtime (fp32 or int8), behind the same
+encode(texts) interface with configurable threads and batch size.
+"""
+
+import inspect
+import os
+import re
+from typing import List
+
+import numpy as np
+
+try:
+    import onnxruntime
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+
+EMBEDDING_BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+# Backends whose vectors differ measurably from the fp32 PyTorch model
+QUANTIZED_BACKENDS = ('torch-int8', 'onnx-int8')
+
+
+def embedding_model_id(model_name: str, backend: str) -> str:
+    """Name stored with embeddings and index snapshots.
+
+    Quantized backends get their own id so switching to or from them
+    re-embeds the knowledge base; fp32 ONNX matches PyTorch and shares its id.
+    """
+    if backend in QUANTIZED_BACKENDS:
+        return f"{model_name}@{backend}"
+    return model_name
+
+
+class TorchEmbeddingModel:
+    """SentenceTransformer in PyTorch, optionally with int8 dynamic quantization of its Linear layers"""
+
+    def __init__(self, model_name: str, quantize: bool = False, threads: int = 0, batch_size: int = 32):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+        model = SentenceTransformer(model_name, device='cpu')
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.batch_size = batch_size
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(
+            self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True), dtype='float32'
+        )
+
+
+class OnnxEmbeddingModel:
+    """SentenceTransformer exported to ONNX and run with ONNX Runtime.
+
+    The transformer is exported once to cache_dir (and quantized to int8 if
+    asked); pooling and normalisation are done here in NumPy to match the
+    SentenceTransformer pipeline.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, quantize: bool = False,
+                 threads: int = 0, batch_size: int = 32):
+        if not ONNXRUNTIME_AVAILABLE:
+            raise ImportError("onnxruntime is required for the onnx embedding backends")
+
+        from sentence_transformers import SentenceTransformer
+        from sentence_transformers.models import Normalize
+
+        model = SentenceTransformer(model_name, device='cpu')
+        transformer, pooling = model[0], model[1]
+        if not (pooling.pooling_mode_mean_tokens or pooling.pooling_mode_cls_token):
+            raise ValueError("Only mean or CLS pooling models can run on the onnx backend")
+
+        self.tokenizer = transformer.tokenizer
+        self.max_seq_length = transformer.max_seq_length
+        self.mean_pooling = bool(pooling.pooling_mode_mean_tokens)
+        self.normalize = any(isinstance(module, Normalize) for module in model)
+        self.batch_size = batch_size
+
+        model_path = self._export(transformer, model_name, cache_dir, quantize)
+
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _export(self, transformer, model_name: str, cache_dir: str, quantize: bool) -> str:
+        import torch
+
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        fp32_path = os.path.join(cache_dir, f"{safe_name}.onnx")
+        int8_path = os.path.join(cache_dir, f"{safe_name}-int8.onnx")
+
+        if not os.path.exists(fp32_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            auto_model = transformer.auto_model.eval()
+            sample = self.tokenizer(["export"], return_tensors='pt')
+            # The export feeds inputs positionally, so they must follow forward()'s
+            # parameter order (input_ids, attention_mask, token_type_ids for BERT),
+            # not whatever order the tokenizer happened to return them in
+            forward_params = list(inspect.signature(auto_model.forward).parameters)
+            input_names = sorted(sample.keys(), key=forward_params.index)
+            dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+            dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+            # Export to a temporary name so a crash never leaves a half-written model behind
+            tmp_path = f"{fp32_path}.tmp{os.getpid()}"
+            with torch.no_grad():
+                torch.onnx.export(
+                    auto_model,
+                    tuple(sample[name] for name in input_names),
+                    tmp_path,
+                    input_names=input_names,
+                    output_names=['last_hidden_state'],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14
+                )
+            os.replace(tmp_path, fp32_path)
+
+        if not quantize:
+            return fp32_path
+
+        if not os.path.exists(int8_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            tmp_path = f"{int8_path}.tmp{os.getpid()}"
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+        return int8_path
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                list(texts[start:start + self.batch_size]), padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors='np'
+            )
+            inputs = {name: value.astype('int64') for name, value in batch.items() if name in self.input_names}
+            token_embeddings = self.session.run(['last_hidden_state'], inputs)[0]
+
+            if self.mean_pooling:
+                mask = batch['attention_mask'][..., None].astype('float32')
+                embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            else:
+                embeddings = token_embeddings[:, 0]
+
+            if self.normalize:
+                embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+            batches.append(embeddings.astype('float32'))
+
+        if not batches:
+            return np.empty((0, 0), dtype='float32')
+        return np.vstack(batches)
+
+
+def load_embedding_model(model_name: str, backend: str = 'torch', threads: int = 0,
+                         batch_size: int = 32, cache_dir: str = './model_cache'):
+    """Load the embedding model on the chosen backend"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    if backend.startswith('onnx'):
+        return OnnxEmbeddingModel(model_name, cache_dir, quantize=backend == 'onnx-int8',
+                                  threads=threads, batch_size=batch_size)
+    return TorchEmbeddingModel(model_name, quantize=backend == 'torch-int8',
+                               threads=threads, batch_size=batch_size)
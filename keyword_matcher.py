@@ -0,0 +1,113 @@
+"""
+Compiled Keyword Matcher
+Scans an email once against every configured keyword list (support filter,
+urgency, emotional intensity and categories) using a single trie-shaped regex.
+"""
+
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from config import settings
+
+
+def _trie_pattern(terms: Iterable[str]) -> str:
+    """Build a regex that matches the longest of the terms, with shared prefixes factored out"""
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def render(node: Dict) -> str:
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A term ending here makes the longer continuations optional; greedy keeps longest first
+        if '' in node:
+            return '(?:' + pattern + ')?'
+        return pattern
+
+    return render(trie)
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+class KeywordHits:
+    """Keywords found in one text, grouped by rule set"""
+
+    def __init__(self):
+        self.matched: Dict[str, Set[str]] = defaultdict(set)
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def distinct(self, rule: str) -> int:
+        """Number of different keywords of a rule set present in the text"""
+        return len(self.matched.get(rule, ()))
+
+    def occurrences(self, rule: str) -> int:
+        """Number of keyword occurrences of a rule set in the text"""
+        return self.counts.get(rule, 0)
+
+
+class KeywordMatcher:
+    """Finds every keyword occurrence for many rule sets in one pass over the text.
+
+    Rule sets in whole_word_rules only match on word boundaries (like \\b in a
+    regex); all other rule sets match anywhere, like a substring check.
+    """
+
+    def __init__(self, rule_sets: Dict[str, Iterable[str]], whole_word_rules: Iterable[str] = ()):
+        whole_word_rules = set(whole_word_rules)
+        self.rules: Dict[str, List] = defaultdict(list)
+        for rule, keywords in rule_sets.items():
+            for keyword in keywords:
+                self.rules[keyword.lower()].append((rule, rule in whole_word_rules))
+
+        terms = sorted(self.rules)
+        # Every keyword that is a prefix of a longer match starts at the same position
+        self._prefix_terms = {
+            term: [other for other in terms if term.startswith(other)] for term in terms
+        }
+        self._pattern = re.compile('(?=(' + _trie_pattern(terms) + '))')
+
+    def scan(self, text: str) -> KeywordHits:
+        """Scan lowercased text once and return the hits for every rule set"""
+        text = text.lower()
+        hits = KeywordHits()
+
+        for match in self._pattern.finditer(text):
+            start = match.start()
+            for term in self._prefix_terms[match.group(1)]:
+                end = start + len(term)
+                at_word_boundary = (
+                    (start == 0 or not _is_word_char(text[start - 1]))
+                    and (end == len(text) or not _is_word_char(text[end]))
+                )
+                for rule, whole_word in self.rules[term]:
+                    if whole_word and not at_word_boundary:
+                        continue
+                    hits.matched[rule].add(term)
+                    hits.counts[rule] += 1
+
+        return hits
+
+
+def build_keyword_matcher() -> KeywordMatcher:
+    """Compile the matcher from the keyword lists in settings"""
+    rule_sets = {
+        'support': settings.SUPPORT_KEYWORDS,
+        'urgency': settings.URGENCY_KEYWORDS,
+        'time_sensitive': settings.TIME_SENSITIVE_KEYWORDS,
+        'emotional': settings.EMOTIONAL_KEYWORDS,
+    }
+    for category, keywords in settings.CATEGORY_KEYWORDS.items():
+        rule_sets[f'category:{category}'] = keywords
+
+    return KeywordMatcher(rule_sets, whole_word_rules=['time_sensitive'])
+
+
+keyword_matcher = build_keyword_matcher()
@@ -0,0 +1,403 @@
+"""
+Async LLM Client
+Routes every chat completion through one event loop with a bounded
+concurrency semaphore, per-call timeouts and jittered exponential backoff on
+rate limits and server errors. A circuit breaker fails calls fast while the
+provider is down. Every call is recorded in llm_metrics under the caller's
+operation name.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import openai
+
+from config import settings
+from llm_metrics import llm_metrics
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """Raised when a completion fails after all retries"""
+
+    def __init__(self, message: str, retries: int = 0):
+        super().__init__(message)
+        self.retries = retries
+
+
+class CircuitOpenError(LLMError):
+    """Raised without calling the provider while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for the LLM provider.
+
+    closed: calls go through. open: calls fail immediately until reset_timeout
+    has passed. half_open: a single probe call goes through; its success
+    closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.short_circuited = 0
+        self.last_error = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go to the provider now; reserves the probe when half-open"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == 'open'
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            self._probe_in_flight = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def release_probe(self):
+        """Give up the probe slot without a verdict, e.g. when the probe was cancelled"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            probe_in = None
+            if self.state == 'open':
+                probe_in = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout_seconds': self.reset_timeout,
+                'probe_in_seconds': probe_in,
+                'times_opened': self.times_opened,
+                'short_circuited': self.short_circuited,
+                'last_error': self.last_error,
+            }
+
+
+class LLMResult:
+    """Text and usage of one completed chat request"""
+
+    def __init__(self, text: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 latency: float = 0.0, retries: int = 0):
+        self.text = text
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.latency = latency
+        self.retries = retries
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """HTTP status of an OpenAI error across SDK versions"""
+    return getattr(error, 'status_code', None) or getattr(error, 'http_status', None)
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # Connection errors carry no status code
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError', 'Timeout', 'ServiceUnavailableError')
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, if it said so"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMClient:
+    """Shared async chat-completion client with its own background event loop.
+
+    Sync callers use complete(), async callers await acomplete(); both run the
+    request on the client's loop so the concurrency limit covers the process.
+    """
+
+    def __init__(self, max_concurrency: int, max_retries: int, timeout: float,
+                 backoff_base: float, backoff_max: float, breaker: CircuitBreaker):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self._loop = None
+        self._semaphore = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    thread = threading.Thread(target=loop.run_forever, name="llm-client", daemon=True)
+                    thread.start()
+                    self._semaphore = asyncio.run_coroutine_threadsafe(
+                        self._make_semaphore(), loop
+                    ).result()
+                    self._loop = loop
+        return self._loop
+
+    async def _make_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.max_concurrency)
+
+    async def _create(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                      stream: bool = False):
+        if hasattr(openai, 'AsyncOpenAI'):
+            if self._client is None:
+                # Retries are handled here, not by the SDK
+                self._client = openai.AsyncOpenAI(
+                    api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_API_BASE or None, max_retries=0
+                )
+            return await self._client.chat.completions.create(
+                model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=stream
+            )
+        extra = {'api_base': settings.OPENAI_API_BASE} if settings.OPENAI_API_BASE else {}
+        return await openai.ChatCompletion.acreate(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=stream, **extra
+        )
+
+    async def _complete(self, messages: List[Dict], model: str, max_tokens: int,
+                        temperature: float, timeout: float) -> LLMResult:
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    self._check_circuit(attempt)
+                    start = time.perf_counter()
+                    try:
+                        response = await asyncio.wait_for(
+                            self._create(messages, model, max_tokens, temperature), timeout
+                        )
+                    except asyncio.CancelledError:
+                        self.breaker.release_probe()
+                        raise
+                self.breaker.record_success()
+                usage = getattr(response, 'usage', None)
+                return LLMResult(
+                    text=response.choices[0].message.content or '',
+                    model=model,
+                    prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                    completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                    latency=time.perf_counter() - start,
+                    retries=attempt
+                )
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                self._record_attempt_error(e)
+                if attempt >= self.max_retries or not _is_retryable(e) or self.breaker.is_open:
+                    raise LLMError(f"{type(e).__name__}: {e}", retries=attempt) from e
+
+                # Exponential backoff with jitter, or whatever the provider asked for
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _stream(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                      timeout: float, emit: Callable[[object], None]):
+        """Stream deltas to emit(); retries only while nothing has been emitted yet"""
+        attempt = 0
+        emitted = False
+        while True:
+            try:
+                async with self._semaphore:
+                    self._check_circuit(attempt)
+                    try:
+                        stream = await asyncio.wait_for(
+                            self._create(messages, model, max_tokens, temperature, stream=True), timeout
+                        )
+                    except asyncio.CancelledError:
+                        self.breaker.release_probe()
+                        raise
+                    # The provider answered; errors mid-stream are not an outage
+                    self.breaker.record_success()
+                    chunks = stream.__aiter__()
+                    while True:
+                        try:
+                            # The timeout bounds the gap between tokens, not the whole stream
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            return
+                        if not chunk.choices:
+                            continue
+                        delta = getattr(chunk.choices[0].delta, 'content', None)
+                        if delta:
+                            emitted = True
+                            emit(delta)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if not emitted:
+                    self._record_attempt_error(e)
+                if emitted or attempt >= self.max_retries or not _is_retryable(e) or self.breaker.is_open:
+                    raise LLMError(f"{type(e).__name__}: {e}", retries=attempt) from e
+
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def _check_circuit(self, attempt: int):
+        if not self.breaker.allow():
+            raise CircuitOpenError("Circuit breaker is open, not calling the LLM provider", retries=attempt)
+
+    def _record_attempt_error(self, error: Exception):
+        # Only outage-like errors count; a rejected request still means the provider is up
+        if _is_retryable(error):
+            self.breaker.record_failure(error)
+        else:
+            self.breaker.record_success()
+
+    async def astream(self, messages: List[Dict], max_tokens: int, temperature: float,
+                      model: Optional[str] = None, timeout: Optional[float] = None,
+                      operation: str = 'completion') -> AsyncIterator[str]:
+        """Yield completion text deltas as the model produces them"""
+        model = model or settings.OPENAI_MODEL
+        loop = self._ensure_loop()
+        caller_loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def emit(item):
+            caller_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def produce():
+            try:
+                await self._stream(messages, model, max_tokens, temperature, timeout or self.timeout, emit)
+            except Exception as e:
+                emit(e)
+            finally:
+                emit(done)
+
+        started = time.perf_counter()
+        deltas = 0
+        outcome = 'cancelled'
+        retries = 0
+        producer = asyncio.run_coroutine_threadsafe(produce(), loop)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    outcome = 'ok'
+                    return
+                if isinstance(item, Exception):
+                    outcome = 'short_circuit' if isinstance(item, CircuitOpenError) else 'error'
+                    retries = getattr(item, 'retries', 0)
+                    raise item
+                deltas += 1
+                yield item
+        finally:
+            # Stop generating if the consumer went away early
+            producer.cancel()
+            # Streams carry no usage block; each delta is roughly one token
+            llm_metrics.record_completion(
+                operation, model, time.perf_counter() - started, outcome,
+                completion_tokens=deltas, retries=retries
+            )
+
+    def _submit(self, messages: List[Dict], model: str, max_tokens: int,
+                temperature: float, timeout: Optional[float]):
+        loop = self._ensure_loop()
+        coroutine = self._complete(messages, model, max_tokens, temperature, timeout or self.timeout)
+        return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    @staticmethod
+    def _record(operation: str, model: str, started: float, result: Optional[LLMResult] = None,
+                error: Optional[Exception] = None):
+        # Recorded on the caller's side so the call lands in the caller's trace;
+        # latency includes queueing on the semaphore and retry backoff
+        latency = time.perf_counter() - started
+        if result is not None:
+            llm_metrics.record_completion(
+                operation, result.model, latency, 'ok', prompt_tokens=result.prompt_tokens,
+                completion_tokens=result.completion_tokens, retries=result.retries
+            )
+        else:
+            outcome = 'short_circuit' if isinstance(error, CircuitOpenError) else 'error'
+            llm_metrics.record_completion(operation, model, latency, outcome, retries=getattr(error, 'retries', 0))
+
+    def complete(self, messages: List[Dict], max_tokens: int, temperature: float,
+                 model: Optional[str] = None, timeout: Optional[float] = None,
+                 operation: str = 'completion') -> LLMResult:
+        """Run a chat completion from synchronous code"""
+        model = model or settings.OPENAI_MODEL
+        started = time.perf_counter()
+        try:
+            result = self._submit(messages, model, max_tokens, temperature, timeout).result()
+        except Exception as e:
+            self._record(operation, model, started, error=e)
+            raise
+        self._record(operation, model, started, result=result)
+        return result
+
+    async def acomplete(self, messages: List[Dict], max_tokens: int, temperature: float,
+                        model: Optional[str] = None, timeout: Optional[float] = None,
+                        operation: str = 'completion') -> LLMResult:
+        """Run a chat completion without blocking the caller's event loop"""
+        model = model or settings.OPENAI_MODEL
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wrap_future(self._submit(messages, model, max_tokens, temperature, timeout))
+        except Exception as e:
+            self._record(operation, model, started, error=e)
+            raise
+        self._record(operation, model, started, result=result)
+        return result
+
+
+llm_client = LLMClient(
+    max_concurrency=settings.OPENAI_MAX_CONCURRENCY,
+    max_retries=settings.OPENAI_MAX_RETRIES,
+    timeout=settings.OPENAI_TIMEOUT_SECONDS,
+    backoff_base=settings.OPENAI_BACKOFF_BASE_SECONDS,
+    backoff_max=settings.OPENAI_BACKOFF_MAX_SECONDS,
+    breaker=CircuitBreaker(
+        failure_threshold=settings.OPENAI_CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=settings.OPENAI_CIRCUIT_RESET_SECONDS
+    )
+)
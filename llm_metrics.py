@@ -0,0 +1,217 @@
+"""
+LLM Call Instrumentation
+Records latency histograms, token usage, retries and outcome for every
+completion and embedding call, aggregated per operation for the metrics API
+and collected per request so the outcome can be stored on the email.
+"""
+
+import contextvars
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Upper bounds in seconds; the last bucket catches everything slower
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Histogram:
+    """Fixed-bucket latency histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict:
+        return {
+            'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                        for bound, count in zip(self.buckets, self.counts)},
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class CallRecord:
+    """One instrumented call"""
+
+    def __init__(self, kind: str, operation: str, model: str, latency: float, outcome: str,
+                 prompt_tokens: int = 0, completion_tokens: int = 0, retries: int = 0, items: int = 0):
+        self.kind = kind
+        self.operation = operation
+        self.model = model
+        self.latency = latency
+        self.outcome = outcome
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.retries = retries
+        self.items = items
+
+
+class CallTrace:
+    """Calls made while handling one request, e.g. generating one email's response"""
+
+    def __init__(self):
+        self.calls: List[CallRecord] = []
+        self.fallback = False
+        self.cached = False
+
+    @property
+    def completions(self) -> List[CallRecord]:
+        return [call for call in self.calls if call.kind == 'completion']
+
+    @property
+    def outcome(self) -> str:
+        if self.fallback:
+            return 'fallback'
+        if self.cached and not self.completions:
+            return 'cached'
+        if any(call.outcome == 'ok' for call in self.completions):
+            return 'ok'
+        return 'error' if self.completions else 'none'
+
+    def summary(self) -> Dict:
+        """Totals over the trace's completion calls"""
+        completions = self.completions
+        return {
+            'model': completions[-1].model if completions else None,
+            'latency_ms': round(sum(call.latency for call in completions) * 1000, 1) if completions else None,
+            'prompt_tokens': sum(call.prompt_tokens for call in completions),
+            'completion_tokens': sum(call.completion_tokens for call in completions),
+            'retries': sum(call.retries for call in completions),
+            'outcome': self.outcome,
+        }
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('llm_call_trace', default=None)
+
+
+class _OperationStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.outcomes = defaultdict(int)
+        self.models = defaultdict(int)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.items = 0
+
+    def to_dict(self) -> Dict:
+        return {
+            'calls': self.latency.count,
+            'outcomes': dict(self.outcomes),
+            'models': dict(self.models),
+            'latency_seconds': self.latency.to_dict(),
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'retries': self.retries,
+            'items': self.items,
+        }
+
+
+class LLMMetrics:
+    """Process-wide aggregates of instrumented calls, keyed by kind and operation"""
+
+    def __init__(self):
+        self._stats: Dict[tuple, _OperationStats] = defaultdict(_OperationStats)
+        self._fallbacks: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _record(self, record: CallRecord):
+        with self._lock:
+            stats = self._stats[(record.kind, record.operation)]
+            stats.latency.observe(record.latency)
+            stats.outcomes[record.outcome] += 1
+            stats.models[record.model] += 1
+            stats.prompt_tokens += record.prompt_tokens
+            stats.completion_tokens += record.completion_tokens
+            stats.retries += record.retries
+            stats.items += record.items
+
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.calls.append(record)
+
+    def record_completion(self, operation: str, model: str, latency: float, outcome: str,
+                          prompt_tokens: int = 0, completion_tokens: int = 0, retries: int = 0):
+        """Record one chat completion, successful or not"""
+        self._record(CallRecord('completion', operation, model, latency, outcome,
+                                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=retries))
+
+    def record_embedding(self, operation: str, model: str, latency: float, outcome: str, items: int):
+        """Record one embedding model call over a batch of texts"""
+        self._record(CallRecord('embedding', operation, model, latency, outcome, items=items))
+
+    def record_fallback(self, operation: str):
+        """Record that an operation answered with its local fallback instead of the LLM"""
+        with self._lock:
+            self._fallbacks[operation] += 1
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.fallback = True
+
+    def record_cache_hit(self):
+        """Mark the current trace as answered from the cache"""
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.cached = True
+
+    @contextmanager
+    def trace(self):
+        """Collect the calls made inside the block, across threads started with asyncio.to_thread"""
+        trace = CallTrace()
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # An async generator closed from another context, e.g. a dropped stream
+                pass
+
+    def snapshot(self) -> Dict:
+        """Aggregates for the metrics API"""
+        with self._lock:
+            result = {'completions': {}, 'embeddings': {}, 'fallbacks': dict(self._fallbacks)}
+            for (kind, operation), stats in self._stats.items():
+                result['completions' if kind == 'completion' else 'embeddings'][operation] = stats.to_dict()
+
+            completion_calls = sum(
+                stats.latency.count for (kind, _), stats in self._stats.items() if kind == 'completion'
+            )
+            fallbacks = sum(self._fallbacks.values())
+            result['fallback_rate'] = round(fallbacks / completion_calls, 4) if completion_calls else 0.0
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._fallbacks.clear()
+
+
+llm_metrics = LLMMetrics()
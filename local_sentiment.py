@@ -0,0 +1,98 @@
+"""
+Local Sentiment Classifier
+Lexicon-based sentiment scoring that runs offline, so only emails it is
+unsure about need to be sent to the LLM.
+"""
+
+import re
+from typing import Dict, Iterable, List, Tuple
+
+# Word weights; negative values indicate negative sentiment
+SENTIMENT_LEXICON: Dict[str, float] = {
+    # Positive
+    'happy': 1.0, 'satisfied': 1.0, 'great': 1.0, 'excellent': 1.5, 'love': 1.5,
+    'amazing': 1.5, 'wonderful': 1.5, 'fantastic': 1.5, 'awesome': 1.5, 'perfect': 1.0,
+    'pleased': 1.0, 'helpful': 1.0, 'appreciate': 1.0, 'glad': 1.0, 'impressed': 1.0,
+    'thanks': 0.5, 'thank': 0.5, 'good': 0.5, 'resolved': 0.5,
+    # Negative
+    'frustrated': -1.5, 'frustrating': -1.5, 'angry': -1.5, 'disappointed': -1.5,
+    'disappointing': -1.5, 'terrible': -1.5, 'hate': -1.5, 'awful': -1.5, 'horrible': -1.5,
+    'worst': -1.5, 'unacceptable': -1.5, 'ridiculous': -1.5, 'useless': -1.5,
+    'unhappy': -1.0, 'dissatisfied': -1.0, 'upset': -1.0, 'annoyed': -1.0, 'poor': -1.0,
+    'desperate': -1.0, 'helpless': -1.0, 'complaint': -1.0, 'broken': -1.0, 'bad': -0.5,
+}
+
+NEGATIONS = {'not', 'no', 'never', "don't", "doesn't", "didn't", "isn't", "wasn't", "can't", 'cannot'}
+
+# Weight of extra negative cues, e.g. outage phrases like "down" or "cannot access"
+NEGATIVE_CUE_WEIGHT = -1.0
+
+# Confidence assigned to texts without any sentiment-bearing words: the lowest
+# possible, so they are always left to the LLM
+NO_SIGNAL_CONFIDENCE = 0.5
+
+_TOKEN_PATTERN = re.compile(r"[a-z']+")
+
+
+class LocalSentimentClassifier:
+    """Scores sentiment from a weighted lexicon with simple negation handling"""
+
+    def __init__(self, lexicon: Dict[str, float] = None, negative_cues: Iterable[str] = ()):
+        """negative_cues are extra words or phrases (e.g. "not working") that count as negative"""
+        self.lexicon = dict(lexicon or SENTIMENT_LEXICON)
+        # Multi-word phrases, keyed by their first word
+        self.phrases: Dict[str, List[Tuple[Tuple[str, ...], float]]] = {}
+        for cue in negative_cues:
+            words = tuple(_TOKEN_PATTERN.findall(cue.lower()))
+            if len(words) == 1:
+                self.lexicon.setdefault(words[0], NEGATIVE_CUE_WEIGHT)
+            elif words:
+                self.phrases.setdefault(words[0], []).append((words, NEGATIVE_CUE_WEIGHT))
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        """Return (sentiment, confidence) where confidence is in [0.5, 1.0]"""
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+
+        # (position, weight) of every cue; words inside a phrase are not cues or
+        # negations of their own, so "cannot access" is one negative cue
+        cues = []
+        in_phrase = set()
+        for i, token in enumerate(tokens):
+            if i in in_phrase:
+                continue
+            for words, weight in self.phrases.get(token, ()):
+                if tuple(tokens[i:i + len(words)]) == words:
+                    cues.append((i, weight))
+                    in_phrase.update(range(i, i + len(words)))
+                    break
+            else:
+                weight = self.lexicon.get(token)
+                if weight is not None:
+                    cues.append((i, weight))
+
+        positive = negative = 0.0
+        for i, weight in cues:
+            # "not happy" counts as mildly negative, "not bad" as mildly positive
+            if any(tokens[j] in NEGATIONS and j not in in_phrase for j in range(max(0, i - 3), i)):
+                weight = -weight * 0.5
+
+            if weight > 0:
+                positive += weight
+            else:
+                negative -= weight
+
+        total = positive + negative
+        if total == 0:
+            return 'neutral', NO_SIGNAL_CONFIDENCE
+
+        net = positive - negative
+        if net > 0:
+            sentiment = 'positive'
+        elif net < 0:
+            sentiment = 'negative'
+        else:
+            sentiment = 'neutral'
+
+        # Agreement between signals, discounted when there is little evidence
+        confidence = 0.5 + 0.5 * (abs(net) / total) * min(1.0, total / 2)
+        return sentiment, confidence
@@ -1,13 +1,15 @@
 from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
+import asyncio
 import json
 from datetime import datetime, timedelta
 
-from database import get_db, Email, EmailAnalytics, KnowledgeBase
+from config import settings
+from database import get_db, SessionLocal, Email, EmailAnalytics, KnowledgeBase, priority_queue_key
 from models import (
     EmailResponse, EmailUpdate, EmailFilter, EmailAnalyticsResponse,
     KnowledgeBaseCreate, KnowledgeBaseResponse, AIResponseRequest,
@@ -16,6 +18,9 @@ from models import (
 )
 from email_service import EmailService
 from ai_service import AIService
+from analysis_cache import analysis_cache
+from llm_client import llm_client
+from llm_metrics import llm_metrics
 
 app = FastAPI(
     title="AI-Powered Email Communication Assistant",
@@ -36,6 +41,26 @@ app.add_middleware(
 email_service = EmailService()
 ai_service = AIService()
 
+@app.on_event("startup")
+async def load_knowledge_base_index():
+    """Load the knowledge base index snapshot, rebuilding it only if the KB changed"""
+    db = SessionLocal()
+    try:
+        ai_service.build_knowledge_base_index(db)
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def backfill_urgency_scores():
+    """Key emails stored before the priority queue was keyed on priority and urgency_score"""
+    db = SessionLocal()
+    try:
+        updated = email_service.backfill_urgency_scores(db)
+        if updated:
+            print(f"Backfilled priority queue keys for {updated} emails")
+    finally:
+        db.close()
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Serve the main dashboard"""
@@ -350,11 +375,35 @@ async def get_priority_queue(db: Session = Depends(get_db)):
 async def sync_emails(background_tasks: BackgroundTasks):
     """Sync emails from email server"""
     try:
-        result = email_service.sync_emails()
+        # IMAP and LLM calls block, so run the sync in a worker thread
+        result = await asyncio.to_thread(email_service.sync_emails)
         return result
     except Exception as e:
         return {"success": False, "message": f"Error syncing emails: {e}", "processed": 0}
 
+@app.post("/api/emails/classify", response_model=EmailProcessingResponse)
+async def classify_emails(request: EmailProcessingRequest, db: Session = Depends(get_db)):
+    """Re-run priority and category classification for a batch of emails"""
+    emails = db.query(Email).filter(Email.id.in_(request.email_ids)).all()
+    if not emails:
+        return EmailProcessingResponse(processed_count=0, success=True, message="No matching emails found")
+    
+    classification = ai_service.classify_batch(
+        [{'subject': email.subject or '', 'body': email.body or ''} for email in emails]
+    )
+    for i, email in enumerate(emails):
+        email.priority = classification['priority'][i]
+        email.urgency_score = int(classification['urgency_score'][i])
+        email.queue_key = priority_queue_key(email.priority, email.urgency_score, email.received_date)
+        email.category = classification['category'][i]
+    db.commit()
+    
+    return EmailProcessingResponse(
+        processed_count=len(emails),
+        success=True,
+        message=f"Classified {len(emails)} emails"
+    )
+
 @app.post("/api/emails/{email_id}/generate-response", response_model=AIResponseResponse)
 async def generate_ai_response(
     email_id: int,
@@ -362,7 +411,7 @@ async def generate_ai_response(
     db: Session = Depends(get_db)
 ):
     """Generate AI response for an email"""
-    response = email_service.generate_ai_response(
+    response = await email_service.agenerate_ai_response(
         email_id, 
         request.custom_prompt, 
         db
@@ -377,6 +426,32 @@ async def generate_ai_response(
         reasoning="AI response generated successfully"
     )
 
+@app.post("/api/emails/{email_id}/generate-response/stream")
+async def stream_ai_response(
+    email_id: int,
+    request: AIResponseRequest,
+    db: Session = Depends(get_db)
+):
+    """Stream an AI response for an email as Server-Sent Events"""
+    if not db.query(Email.id).filter(Email.id == email_id).first():
+        raise HTTPException(status_code=404, detail="Email not found")
+    
+    async def event_stream():
+        chunks = []
+        try:
+            async for delta in email_service.astream_ai_response(email_id, request.custom_prompt):
+                chunks.append(delta)
+                yield f"data: {json.dumps({'token': delta})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'response': ''.join(chunks)})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': f'Error generating response: {e}'})}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/emails/{email_id}/send-response")
 async def send_email_response(
     email_id: int,
@@ -402,8 +477,12 @@ async def update_email(
     if not email:
         raise HTTPException(status_code=404, detail="Email not found")
     
-    for field, value in email_update.dict(exclude_unset=True).items():
+    updates = email_update.dict(exclude_unset=True)
+    for field, value in updates.items():
         setattr(email, field, value)
+    if 'priority' in updates:
+        # A manual priority override moves the email within the queue
+        email.queue_key = priority_queue_key(email.priority, email.urgency_score, email.received_date)
     
     db.commit()
     db.refresh(email)
@@ -479,6 +558,21 @@ async def get_dashboard_stats(db: Session = Depends(get_db)):
         category_distribution=category_distribution
     )
 
+@app.get("/api/ai/cache/stats")
+async def get_ai_cache_stats():
+    """Get hit/miss counters for the AI analysis cache"""
+    return analysis_cache.stats()
+
+@app.get("/api/ai/circuit")
+async def get_ai_circuit():
+    """Get the state of the LLM provider circuit breaker"""
+    return llm_client.breaker.snapshot()
+
+@app.get("/api/ai/metrics")
+async def get_ai_metrics():
+    """Get latency histograms, token usage, retries and outcomes of LLM and embedding calls"""
+    return llm_metrics.snapshot()
+
 @app.get("/api/knowledge-base/", response_model=List[KnowledgeBaseResponse])
 async def get_knowledge_base(db: Session = Depends(get_db)):
     """Get all knowledge base items"""
@@ -496,8 +590,30 @@ async def create_knowledge_base_item(
     db.commit()
     db.refresh(db_item)
     
-    # Update AI service knowledge base index
-    ai_service.build_knowledge_base_index(db)
+    # Embedding the item (and loading the model on first use) blocks, so keep it off the event loop
+    await asyncio.to_thread(ai_service.upsert_knowledge_base_item, db_item, db)
+    
+    return db_item
+
+@app.put("/api/knowledge-base/{item_id}", response_model=KnowledgeBaseResponse)
+async def update_knowledge_base_item(
+    item_id: int,
+    item: KnowledgeBaseCreate,
+    db: Session = Depends(get_db)
+):
+    """Update knowledge base item"""
+    db_item = db.query(KnowledgeBase).filter(KnowledgeBase.id == item_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Knowledge base item not found")
+    
+    for field, value in item.dict().items():
+        setattr(db_item, field, value)
+    
+    db.commit()
+    db.refresh(db_item)
+    
+    # Embedding the item (and loading the model on first use) blocks, so keep it off the event loop
+    await asyncio.to_thread(ai_service.upsert_knowledge_base_item, db_item, db)
     
     return db_item
 
@@ -511,8 +627,8 @@ async def delete_knowledge_base_item(item_id: int, db: Session = Depends(get_db)
     db.delete(item)
     db.commit()
     
-    # Update AI service knowledge base index
-    ai_service.build_knowledge_base_index(db)
+    # Rewriting the index snapshot blocks, so keep it off the event loop
+    await asyncio.to_thread(ai_service.remove_knowledge_base_item, item_id)
     
     return {"message": "Knowledge base item deleted"}
 
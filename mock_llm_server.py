@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI Chat Completions Server
+A local stand-in for the OpenAI API with configurable latency, error rate,
+rate limiting and streaming, so the AI pipeline can be load-tested offline
+and reproducibly. Point the app at it with OPENAI_API_BASE.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_NEGATIVE_WORDS = re.compile(r'\b(angry|broken|terrible|awful|frustrat\w*|unacceptable|refund|worst|down|error)\b', re.I)
+_POSITIVE_WORDS = re.compile(r'\b(thanks|thank you|great|love|excellent|awesome|happy|appreciate)\b', re.I)
+
+_REPLY = (
+    "Dear Customer,\n\n"
+    "Thank you for reaching out, and I'm sorry for the trouble you've experienced. "
+    "I've reviewed your message and our team is looking into it right away. "
+    "In the meantime, please try signing out and back in, and clear your browser cache. "
+    "If the issue persists, reply with any error messages you see and we'll follow up promptly.\n\n"
+    "Best regards,\nCustomer Support Team"
+)
+
+
+class MockBehaviour:
+    """Latency, failure and streaming knobs shared by all request handlers"""
+
+    def __init__(self, latency_ms: float, latency_distribution: str, latency_spread_ms: float,
+                 error_rate: float, rate_limit_rate: float, retry_after: float, token_delay_ms: float,
+                 seed: int = None):
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_spread_ms = latency_spread_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.token_delay_ms = token_delay_ms
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'completed': 0, 'errors': 0, 'rate_limited': 0, 'streamed': 0}
+        self._lock = threading.Lock()
+
+    def latency(self) -> float:
+        """Seconds to wait before answering, drawn from the configured distribution"""
+        with self._lock:
+            if self.latency_distribution == 'uniform':
+                value = self.random.uniform(self.latency_ms - self.latency_spread_ms,
+                                            self.latency_ms + self.latency_spread_ms)
+            elif self.latency_distribution == 'normal':
+                value = self.random.gauss(self.latency_ms, self.latency_spread_ms)
+            elif self.latency_distribution == 'lognormal':
+                # Median latency_ms with a long tail, like real provider latencies
+                sigma = self.latency_spread_ms / self.latency_ms if self.latency_ms else 0
+                value = self.latency_ms * self.random.lognormvariate(0, sigma)
+            else:
+                value = self.latency_ms
+        return max(0.0, value) / 1000
+
+    def outcome(self) -> str:
+        """'rate_limited', 'error' or 'ok' for the next request"""
+        with self._lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return 'rate_limited'
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def mock_completion_text(messages, max_tokens: int) -> str:
+    """A plausible answer for the prompts the app sends"""
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    user = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+
+    def sentiment(text: str) -> str:
+        if _NEGATIVE_WORDS.search(text):
+            return 'negative'
+        if _POSITIVE_WORDS.search(text):
+            return 'positive'
+        return 'neutral'
+
+    if 'JSON array' in system and 'sentiment' in system:
+        # Everything before the first "Email 1:" header is the instruction
+        emails = re.split(r'(?:^|\n\n)Email \d+:\n', user)[1:]
+        return json.dumps([{"id": i, "sentiment": sentiment(email)} for i, email in enumerate(emails, 1)])
+    if 'exactly one word' in system:
+        return sentiment(user)
+
+    # Roughly respect max_tokens like the real API would
+    return _REPLY[:max(1, max_tokens) * 4]
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    behaviour: MockBehaviour = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate the cost of a load test
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('/v1/models', '/models'):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-gpt", "object": "model"}]})
+        elif self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.behaviour.counts)
+        else:
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            return
+
+        behaviour = self.behaviour
+        behaviour.count('requests')
+        time.sleep(behaviour.latency())
+
+        outcome = behaviour.outcome()
+        if outcome == 'rate_limited':
+            behaviour.count('rate_limited')
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error",
+                                            "code": "rate_limit_exceeded"}},
+                            headers={'Retry-After': str(behaviour.retry_after)})
+            return
+        if outcome == 'error':
+            behaviour.count('errors')
+            self._send_json(500, {"error": {"message": "The server had an error (mock)", "type": "server_error"}})
+            return
+
+        messages = request.get('messages', [])
+        model = request.get('model', 'mock-gpt')
+        text = mock_completion_text(messages, int(request.get('max_tokens') or 256))
+
+        if request.get('stream'):
+            behaviour.count('streamed')
+            self._stream(model, text)
+        else:
+            prompt_tokens = sum(_estimate_tokens(m.get('content') or '') for m in messages)
+            completion_tokens = _estimate_tokens(text)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
+                }
+            })
+        behaviour.count('completed')
+
+    def _stream(self, model: str, text: str):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def chunk(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        try:
+            chunk({"role": "assistant", "content": ""})
+            for token in re.findall(r'\S+\s*|\s+', text):
+                time.sleep(self.behaviour.token_delay_ms / 1000)
+                chunk({"content": token})
+            chunk({}, finish_reason="stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client stopped reading, e.g. a cancelled SSE request
+            pass
+
+    def _send_json(self, status: int, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def make_server(host: str, port: int, behaviour: MockBehaviour) -> ThreadingHTTPServer:
+    handler = type('ConfiguredMockOpenAIHandler', (MockOpenAIHandler,), {'behaviour': behaviour})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server for offline load testing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency-ms', type=float, default=800, help="Mean (or median, for lognormal) latency")
+    parser.add_argument('--latency-distribution', choices=['fixed', 'uniform', 'normal', 'lognormal'],
+                        default='lognormal')
+    parser.add_argument('--latency-spread-ms', type=float, default=400,
+                        help="Half-width (uniform), standard deviation (normal) or tail width (lognormal)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 429")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument('--token-delay-ms', type=float, default=20, help="Delay between streamed tokens")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    behaviour = MockBehaviour(
+        latency_ms=args.latency_ms,
+        latency_distribution=args.latency_distribution,
+        latency_spread_ms=args.latency_spread_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        token_delay_ms=args.token_delay_ms,
+        seed=args.seed
+    )
+    server = make_server(args.host, args.port, behaviour)
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1 "
+          f"(set OPENAI_API_BASE=http://{args.host}:{args.port}/v1)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
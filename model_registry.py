@@ -0,0 +1,90 @@
+"""
+Shared Model Registry
+Holds the embedding model and knowledge base indexes once per process, loading
+them lazily on first use so every AIService instance reuses the same copy.
+"""
+
+import threading
+
+from bm25 import BM25Index
+from config import settings
+from embedding_backends import embedding_model_id, load_embedding_model
+from vector_index import KnowledgeBaseIndex
+
+_lock = threading.Lock()
+_embedding_model = None
+_embedding_model_loader = None
+_knowledge_base_index = None
+_bm25_index = None
+
+
+def get_embedding_model():
+    """Return the process-wide embedding model on the configured backend, loading it on first use"""
+    global _embedding_model
+    if _embedding_model is None:
+        with _lock:
+            if _embedding_model is None:
+                _embedding_model = load_embedding_model(
+                    settings.EMBEDDING_MODEL,
+                    backend=settings.EMBEDDING_BACKEND,
+                    threads=settings.EMBEDDING_THREADS,
+                    batch_size=settings.EMBEDDING_BATCH_SIZE,
+                    cache_dir=settings.EMBEDDING_CACHE_DIR
+                )
+    return _embedding_model
+
+
+def load_embedding_model_in_background():
+    """Start loading the embedding model on a daemon thread, once"""
+    global _embedding_model_loader
+    if _embedding_model is not None or _embedding_model_loader is not None:
+        return
+    with _lock:
+        if _embedding_model_loader is None:
+            _embedding_model_loader = threading.Thread(
+                target=_load_embedding_model_quietly, name="embedding-model-loader", daemon=True
+            )
+            _embedding_model_loader.start()
+
+
+def _load_embedding_model_quietly():
+    try:
+        get_embedding_model()
+    except Exception as e:
+        print(f"Error loading embedding model: {e}")
+
+
+def is_embedding_model_loaded() -> bool:
+    """Check whether the embedding model has been loaded in this process"""
+    return _embedding_model is not None
+
+
+def get_knowledge_base_index() -> KnowledgeBaseIndex:
+    """Return the process-wide knowledge base index"""
+    global _knowledge_base_index
+    if _knowledge_base_index is None:
+        with _lock:
+            if _knowledge_base_index is None:
+                _knowledge_base_index = KnowledgeBaseIndex(
+                    settings.KB_INDEX_DIR,
+                    embedding_model_id(settings.EMBEDDING_MODEL, settings.EMBEDDING_BACKEND),
+                    index_type=settings.KB_INDEX_TYPE,
+                    quantization=settings.KB_INDEX_QUANTIZATION,
+                    hnsw_m=settings.KB_HNSW_M,
+                    hnsw_ef_construction=settings.KB_HNSW_EF_CONSTRUCTION,
+                    hnsw_ef_search=settings.KB_HNSW_EF_SEARCH,
+                    ivf_nlist=settings.KB_IVF_NLIST,
+                    ivf_nprobe=settings.KB_IVF_NPROBE,
+                    pq_m=settings.KB_PQ_M
+                )
+    return _knowledge_base_index
+
+
+def get_bm25_index() -> BM25Index:
+    """Return the process-wide BM25 keyword index"""
+    global _bm25_index
+    if _bm25_index is None:
+        with _lock:
+            if _bm25_index is None:
+                _bm25_index = BM25Index()
+    return _bm25_index
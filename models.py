@@ -16,12 +16,20 @@ class EmailResponse(EmailBase):
     message_id: str
     sentiment: Optional[str] = None
     priority: Optional[str] = None
+    urgency_score: Optional[int] = None
     category: Optional[str] = None
     is_processed: bool
     is_responded: bool
     response_generated: Optional[str] = None
     response_sent: bool
     extracted_info: Optional[str] = None
+    cluster_id: Optional[int] = None
+    ai_model: Optional[str] = None
+    ai_latency_ms: Optional[float] = None
+    ai_prompt_tokens: Optional[int] = None
+    ai_completion_tokens: Optional[int] = None
+    ai_retries: Optional[int] = None
+    ai_outcome: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
@@ -0,0 +1,138 @@
+"""
+Near-Duplicate Email Detection
+MinHash signatures over word shingles with LSH banding, used to group
+near-identical emails (e.g. floods after an outage) into clusters that can
+share one AI draft.
+"""
+
+import re
+import time
+import zlib
+from email.utils import parseaddr
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Mersenne prime for the universal hash family; keeps a * x inside uint64
+_MERSENNE_PRIME = (1 << 31) - 1
+_MAX_HASH = np.uint64(_MERSENNE_PRIME)
+
+_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+_GREETING_PATTERN = re.compile(r'^(\s*)(dear|hi|hello|hey)\b[^,\n]*,', re.IGNORECASE | re.MULTILINE)
+
+
+def sender_display_name(sender_email: str) -> Optional[str]:
+    """Display name from a From header such as 'Jane Doe <jane@example.com>'"""
+    name, _ = parseaddr(sender_email or '')
+    return name.strip() or None
+
+
+def personalize_draft(draft: str, draft_sender: Optional[str], sender_email: str) -> str:
+    """Adapt a cluster's draft, written for one sender, to another sender"""
+    name = sender_display_name(sender_email)
+
+    if draft_sender and name and draft_sender != name:
+        draft = re.sub(r'\b' + re.escape(draft_sender) + r'\b', name, draft)
+
+    def greet(match):
+        greeting = match.group(2)
+        fallback = 'Customer' if greeting.lower() == 'dear' else 'there'
+        return f"{match.group(1)}{greeting} {name or fallback},"
+
+    return _GREETING_PATTERN.sub(greet, draft, count=1)
+
+
+class NearDuplicateDetector:
+    """In-memory MinHash LSH index mapping email signatures to cluster ids"""
+
+    def __init__(self, threshold: float, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 3, window_seconds: float = 72 * 3600, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.window_seconds = window_seconds
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self._buckets: Dict[tuple, List[int]] = {}
+        self._signatures: Dict[int, np.ndarray] = {}
+        self._last_seen: Dict[int, float] = {}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature of the text, or None if it has no words"""
+        words = _WORD_PATTERN.findall((text or '').lower())
+        if not words:
+            return None
+
+        size = min(self.shingle_size, len(words))
+        shingles = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+            dtype=np.uint64, count=len(shingles)
+        ) % _MAX_HASH
+
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MAX_HASH
+        return permuted.min(axis=1)
+
+    @staticmethod
+    def similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+        """Estimated Jaccard similarity of two signatures"""
+        return float(np.mean(signature_a == signature_b))
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def find(self, signature: Optional[np.ndarray]) -> Optional[int]:
+        """Cluster id of the most similar indexed email above the threshold"""
+        if signature is None:
+            return None
+
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+
+        best_cluster, best_similarity = None, self.threshold
+        for cluster_id in candidates:
+            similarity = self.similarity(signature, self._signatures[cluster_id])
+            if similarity >= best_similarity:
+                best_cluster, best_similarity = cluster_id, similarity
+
+        if best_cluster is not None:
+            self._last_seen[best_cluster] = time.time()
+        return best_cluster
+
+    def add(self, cluster_id: int, signature: Optional[np.ndarray], seen_at: Optional[float] = None):
+        """Index a cluster's representative signature"""
+        if signature is None or cluster_id in self._signatures:
+            return
+
+        self._prune()
+        self._signatures[cluster_id] = signature
+        self._last_seen[cluster_id] = seen_at or time.time()
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(cluster_id)
+
+    def _prune(self):
+        """Forget clusters that have not been seen within the window"""
+        cutoff = time.time() - self.window_seconds
+        expired = {cluster_id for cluster_id, seen in self._last_seen.items() if seen < cutoff}
+        if not expired:
+            return
+
+        for cluster_id in expired:
+            signature = self._signatures.pop(cluster_id)
+            del self._last_seen[cluster_id]
+            for key in self._band_keys(signature):
+                members = self._buckets.get(key)
+                if members and cluster_id in members:
+                    members.remove(cluster_id)
+                    if not members:
+                        del self._buckets[key]
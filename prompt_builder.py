@@ -0,0 +1,107 @@
+"""
+Token-Budgeted Prompt Assembly
+Counts tokens and fits the email body and knowledge base context into a
+fixed prompt budget, trimming quoted history and low-ranked context first.
+"""
+
+import re
+from typing import List, Tuple
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Rough average for English text when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+# Per-message formatting overhead of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Lines that start the quoted part of a reply
+_REPLY_HEADER_PATTERNS = [
+    re.compile(r'^\s*On .+wrote:\s*$'),
+    re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}\s*$', re.IGNORECASE),
+    re.compile(r'^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$', re.IGNORECASE),
+    re.compile(r'^\s*From:\s.+$'),
+]
+
+
+class TokenCounter:
+    """Counts and truncates text in model tokens"""
+
+    def __init__(self, model: str):
+        self.encoding = None
+        if TIKTOKEN_AVAILABLE:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return -(-len(text) // CHARS_PER_TOKEN)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Keep the start of the text, up to max_tokens"""
+        if self.count(text) <= max_tokens:
+            return text
+        # Leave room for the ellipsis marker
+        keep = max_tokens - 2
+        if keep <= 0:
+            return ""
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text)[:keep]).rstrip() + " ..."
+        return text[:keep * CHARS_PER_TOKEN].rstrip() + " ..."
+
+
+def strip_quoted_text(body: str) -> str:
+    """Drop quoted reply history: '>' lines and everything after a reply header"""
+    kept = []
+    for line in (body or "").splitlines():
+        if any(pattern.match(line) for pattern in _REPLY_HEADER_PATTERNS):
+            break
+        if line.lstrip().startswith('>'):
+            continue
+        kept.append(line)
+
+    stripped = "\n".join(kept).strip()
+    # Never strip an email down to nothing, e.g. a pure forward
+    return stripped or (body or "").strip()
+
+
+def fit_to_budget(counter: TokenCounter, budget: int, fixed_tokens: int, body: str,
+                  contexts: List[str]) -> Tuple[str, List[str]]:
+    """Fit the body and ranked contexts into what is left of the budget after the fixed prompt.
+
+    The body keeps at least half of the remaining budget when it needs it;
+    context items are added in rank order and the first one that does not
+    fit is truncated, dropping everything ranked below it.
+    """
+    available = max(0, budget - fixed_tokens)
+    body_tokens = counter.count(body)
+    context_tokens = sum(counter.count(context) for context in contexts)
+
+    body_cap = max(available // 2, available - context_tokens)
+    if body_tokens > body_cap:
+        body = counter.truncate(body, body_cap)
+        body_tokens = counter.count(body)
+
+    remaining = available - body_tokens
+    fitted = []
+    for context in contexts:
+        tokens = counter.count(context)
+        if tokens <= remaining:
+            fitted.append(context)
+            remaining -= tokens
+            continue
+        # Partial context is only worth keeping if a meaningful chunk fits
+        if remaining >= 32:
+            fitted.append(counter.truncate(context, remaining))
+        break
+
+    return body, fitted
@@ -0,0 +1,586 @@
+"""
+Persistent Vector Index for the Knowledge Base
+Keeps the FAISS index used for RAG on disk as a versioned snapshot so that
+workers can memory-map it on startup instead of re-encoding every article.
+The index is exact brute force (flat) by default, or approximate (HNSW, IVF)
+for knowledge bases too large to scan on every query, optionally with
+quantized vectors to cut the memory each worker spends on it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+import faiss
+
+# Bump whenever the on-disk layout of the snapshot changes
+SNAPSHOT_VERSION = 2
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf')
+QUANTIZATION_MODES = ('none', 'sq8', 'pq')
+
+# FAISS wants roughly this many training points per IVF list
+IVF_MIN_POINTS_PER_LIST = 39
+
+# How many more neighbours to fetch when skipping tombstones after the search instead of during it
+FILTER_OVERFETCH = 10
+
+# Fewer vectors than this cannot train a quantizer well (an 8-bit product
+# quantizer learns 256 centroids per sub-vector), and are small enough anyway
+MIN_QUANTIZATION_TRAINING_POINTS = 256
+
+# A trained index is rebuilt from the database once it holds this many times
+# the vectors it was trained on, so edits through the API keep it fitting
+RETRAIN_GROWTH_FACTOR = 4
+
+# HNSW graphs cannot delete vectors. Replaced and deleted vectors stay in the
+# graph as tombstones, skipped at search time, until they make up this share
+# of it and the graph is rebuilt (or the next full build drops them).
+HNSW_MAX_TOMBSTONE_FRACTION = 0.25
+
+# HNSW labels are item id + generation << LABEL_ID_BITS, so a replaced item's
+# new vector gets a label distinct from its tombstoned old one
+LABEL_ID_BITS = 40
+LABEL_ID_MASK = (1 << LABEL_ID_BITS) - 1
+MAX_LABEL_GENERATION = (1 << (63 - LABEL_ID_BITS)) - 1
+
+
+def item_content_hash(item_id: int, question: str, answer: str) -> str:
+    """Hash the parts of a knowledge base row that feed its embedding"""
+    payload = f"{item_id}\x1f{question or ''}\x1f{answer or ''}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def combine_content_hashes(item_hashes: Iterable[str]) -> str:
+    """Combine per-item hashes into an order-independent knowledge base hash"""
+    combined = 0
+    for item_hash in item_hashes:
+        combined ^= int(item_hash, 16)
+    return f"{combined:064x}"
+
+
+def embedding_to_blob(embedding: np.ndarray) -> bytes:
+    """Serialise an embedding as a compact float32 blob for the database"""
+    return np.asarray(embedding, dtype='float32').tobytes()
+
+
+def blob_to_embedding(blob: bytes) -> np.ndarray:
+    """Deserialise an embedding stored with embedding_to_blob"""
+    return np.frombuffer(blob, dtype='float32')
+
+
+def default_ivf_nlist(n_vectors: int) -> int:
+    """Number of IVF lists for a collection size, about 4 * sqrt(n)"""
+    return max(1, int(4 * np.sqrt(n_vectors)))
+
+
+def effective_quantization(quantization: str, n_vectors: int) -> str:
+    """Quantization create_index actually applies when trained on n_vectors"""
+    return quantization if n_vectors >= MIN_QUANTIZATION_TRAINING_POINTS else 'none'
+
+
+def pq_subquantizers(dimension: int, requested: int) -> int:
+    """Largest number of PQ sub-vectors, at most the requested one, that divides the dimension"""
+    for m in range(min(requested, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(index_type: str, embeddings: np.ndarray, quantization: str = 'none',
+                 hnsw_m: int = 32, hnsw_ef_construction: int = 200, ivf_nlist: int = 0,
+                 pq_m: int = 48):
+    """Create an empty, trained FAISS index of the given type that accepts external ids.
+
+    Flat and HNSW indexes are wrapped in an id map; IVF stores the ids in its
+    inverted lists itself, which also keeps remove_ids working. Vectors are
+    stored as float32, as 8-bit scalar codes (sq8, 4x smaller) or as product
+    quantizer codes (pq, pq_m bytes each). Training uses the given embeddings;
+    IVF list counts are capped by how many there are, and too few of them to
+    train a quantizer keeps the vectors as float32.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {', '.join(INDEX_TYPES)}")
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {', '.join(QUANTIZATION_MODES)}")
+
+    dimension = embeddings.shape[1]
+    quantization = effective_quantization(quantization, len(embeddings))
+    pq_m = pq_subquantizers(dimension, pq_m)
+
+    if index_type == 'ivf':
+        nlist = ivf_nlist or default_ivf_nlist(len(embeddings))
+        nlist = max(1, min(nlist, len(embeddings) // IVF_MIN_POINTS_PER_LIST))
+        coarse_quantizer = faiss.IndexFlatL2(dimension)
+        if quantization == 'sq8':
+            index = faiss.IndexIVFScalarQuantizer(coarse_quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit)
+        elif quantization == 'pq':
+            index = faiss.IndexIVFPQ(coarse_quantizer, dimension, nlist, pq_m, 8)
+        else:
+            index = faiss.IndexIVFFlat(coarse_quantizer, dimension, nlist)
+        index.train(embeddings)
+        return index
+
+    if index_type == 'hnsw':
+        if quantization == 'sq8':
+            base = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, hnsw_m)
+        elif quantization == 'pq':
+            base = faiss.IndexHNSWPQ(dimension, pq_m, hnsw_m)
+        else:
+            base = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        base.hnsw.efConstruction = hnsw_ef_construction
+    else:
+        if quantization == 'sq8':
+            base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+        elif quantization == 'pq':
+            base = faiss.IndexPQ(dimension, pq_m, 8)
+        else:
+            base = faiss.IndexFlatL2(dimension)
+
+    if not base.is_trained:
+        base.train(embeddings)
+    return faiss.IndexIDMap2(base)
+
+
+def mmap_read_flag(index_type: str) -> Optional[int]:
+    """faiss.read_index flag that memory-maps this index type's vectors, if the faiss build has one.
+
+    IO_FLAG_MMAP only maps IVF inverted lists; flat codes (flat, HNSW storage,
+    sq8/pq) need IO_FLAG_MMAP_IFC, which older faiss releases lack.
+    """
+    if index_type == 'ivf':
+        return faiss.IO_FLAG_MMAP
+    return getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+
+
+def is_file_mapped(path: str) -> bool:
+    """Whether this process has the file memory-mapped (Linux); assume so where it can't be checked"""
+    try:
+        with open('/proc/self/maps', 'r', encoding='utf-8') as f:
+            path = os.path.abspath(path)
+            return any(line.rstrip('\n').endswith(path) for line in f)
+    except OSError:
+        return True
+
+
+def set_search_params(index, ivf_nprobe: int = 16, hnsw_ef_search: int = 64):
+    """Apply query-time accuracy/speed knobs to the index, or the one behind its id map"""
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = hnsw_ef_search
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = ivf_nprobe
+
+
+def selector_search_params(index, selector, ivf_nprobe: int = 16, hnsw_ef_search: int = 64):
+    """Search parameters restricting results to the selected ids.
+
+    Parameters replace the index's own query-time settings, so nprobe and
+    efSearch are carried over.
+    """
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw_ef_search)
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf_nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+class KnowledgeBaseIndex:
+    """FAISS index over knowledge base items, keyed by KnowledgeBase.id"""
+
+    def __init__(self, index_dir: str, model_name: str, index_type: str = 'flat', quantization: str = 'none',
+                 hnsw_m: int = 32, hnsw_ef_construction: int = 200, hnsw_ef_search: int = 64,
+                 ivf_nlist: int = 0, ivf_nprobe: int = 16, pq_m: int = 48):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}', expected one of {', '.join(INDEX_TYPES)}")
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization '{quantization}', expected one of {', '.join(QUANTIZATION_MODES)}")
+
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.index_type = index_type
+        self.quantization = quantization
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self.ivf_nlist = ivf_nlist
+        self.ivf_nprobe = ivf_nprobe
+        self.pq_m = pq_m
+        self.index = None
+        # Number of vectors the index was trained on, and the quantization that allowed
+        self.trained_size = 0
+        self.trained_quantization = 'none'
+        self.item_hashes: Dict[int, str] = {}
+        self.answers: Dict[int, str] = {}
+        self.category_members: Dict[str, Set[int]] = {}
+        self._mmapped = False
+        # HNSW only: live label of each item, labels of tombstoned vectors, next label generation
+        self._labels: Dict[int, int] = {}
+        self._stale_labels: Set[int] = set()
+        self._next_generation = 1
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.index_dir, f"kb-v{SNAPSHOT_VERSION}.faiss")
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.index_dir, f"kb-v{SNAPSHOT_VERSION}.json")
+
+    @property
+    def size(self) -> int:
+        """Number of live vectors"""
+        return self.index.ntotal - len(self._stale_labels) if self.index is not None else 0
+
+    @property
+    def content_hash(self) -> str:
+        return combine_content_hashes(self.item_hashes.values())
+
+    @property
+    def needs_retrain(self) -> bool:
+        """Whether the index has outgrown its training and should be rebuilt from the database"""
+        return self.index is not None and self._outgrown(self.trained_quantization, self.trained_size, self.size)
+
+    def _outgrown(self, trained_quantization: str, trained_size: int, n_vectors: int) -> bool:
+        # Started too small to quantize
+        if (trained_quantization == 'none' and self.quantization != 'none'
+                and n_vectors >= MIN_QUANTIZATION_TRAINING_POINTS):
+            return True
+        # IVF lists (capped by the training set size) or a quantizer trained on far
+        # fewer vectors than they now hold
+        trained = self.index_type == 'ivf' or trained_quantization != 'none'
+        return trained and n_vectors > RETRAIN_GROWTH_FACTOR * trained_size
+
+    def _set_trained(self, n_vectors: int):
+        self.trained_size = n_vectors
+        self.trained_quantization = effective_quantization(self.quantization, n_vectors)
+
+    def _create_index(self, embeddings: np.ndarray):
+        index = create_index(
+            self.index_type, embeddings, quantization=self.quantization, hnsw_m=self.hnsw_m,
+            hnsw_ef_construction=self.hnsw_ef_construction, ivf_nlist=self.ivf_nlist, pq_m=self.pq_m
+        )
+        set_search_params(index, ivf_nprobe=self.ivf_nprobe, hnsw_ef_search=self.hnsw_ef_search)
+        return index
+
+    def build(self, ids: List[int], embeddings: np.ndarray, item_hashes: Dict[int, str]):
+        """Build a fresh index from knowledge base ids and their embeddings"""
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        index = self._create_index(embeddings)
+        index.add_with_ids(embeddings, np.asarray(ids, dtype='int64'))
+
+        with self._lock:
+            self.index = index
+            self._set_trained(len(embeddings))
+            self.item_hashes = dict(item_hashes)
+            self._mmapped = False
+            self._reset_labels(ids)
+
+    def _reset_labels(self, ids: Iterable[int]):
+        if self.index_type == 'hnsw':
+            self._labels = {int(item_id): int(item_id) for item_id in ids}
+        else:
+            self._labels = {}
+        self._stale_labels = set()
+        self._next_generation = 1
+
+    def _restore_labels(self, index, item_hashes: Dict[int, str]):
+        """Recover live and tombstoned HNSW labels from a loaded snapshot.
+
+        An item's live vector is its highest-generation label; every other
+        label, and all labels of items no longer in the knowledge base, are
+        tombstones.
+        """
+        self._reset_labels([])
+        if self.index_type != 'hnsw':
+            return
+
+        labels = faiss.vector_to_array(index.id_map)
+        for label in labels.tolist():
+            item_id = label & LABEL_ID_MASK
+            current = self._labels.get(item_id)
+            if item_id not in item_hashes:
+                self._stale_labels.add(label)
+            elif current is None or label > current:
+                if current is not None:
+                    self._stale_labels.add(current)
+                self._labels[item_id] = label
+            else:
+                self._stale_labels.add(label)
+        if len(labels):
+            self._next_generation = int(labels.max() >> LABEL_ID_BITS) + 1
+
+    def clear(self):
+        """Forget every vector, e.g. when the knowledge base is emptied"""
+        with self._lock:
+            self.index = None
+            self._set_trained(0)
+            self.item_hashes = {}
+            self._reset_labels([])
+            self.answers = {}
+            self.category_members = {}
+            self._mmapped = False
+
+    def load(self, item_hashes: Dict[int, str]) -> bool:
+        """Load the snapshot from disk if it matches the current knowledge base"""
+        content_hash = combine_content_hashes(item_hashes.values())
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.index_path)):
+            return False
+
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading knowledge base index metadata: {e}")
+            return False
+
+        # The metadata records the quantization the index was actually trained with,
+        # which is none for a knowledge base too small to train a quantizer
+        trained_size = meta.get('trained_size', 0)
+        trained_quantization = meta.get('quantization', 'none')
+        if (meta.get('version') != SNAPSHOT_VERSION
+                or meta.get('model_name') != self.model_name
+                or meta.get('index_type', 'flat') != self.index_type
+                or trained_quantization != effective_quantization(self.quantization, trained_size)
+                or meta.get('content_hash') != content_hash
+                or self._outgrown(trained_quantization, trained_size, len(item_hashes))):
+            return False
+
+        # Memory-map the vectors so workers share pages instead of copying them;
+        # without a suitable flag the index is read into RAM in every worker
+        index = None
+        mmapped = False
+        flag = mmap_read_flag(self.index_type)
+        if flag is not None:
+            try:
+                index = faiss.read_index(self.index_path, flag)
+                mmapped = is_file_mapped(self.index_path)
+            except RuntimeError:
+                index = None
+        if index is None:
+            index = faiss.read_index(self.index_path)
+        set_search_params(index, ivf_nprobe=self.ivf_nprobe, hnsw_ef_search=self.hnsw_ef_search)
+
+        with self._lock:
+            self.index = index
+            self.trained_size, self.trained_quantization = trained_size, trained_quantization
+            self.item_hashes = dict(item_hashes)
+            self._mmapped = mmapped
+            self._restore_labels(index, item_hashes)
+        return True
+
+    def _ensure_writable(self):
+        """Copy a memory-mapped index into RAM before mutating it.
+
+        The copy is made from this worker's own mapping, not by re-reading the
+        file: another worker may already have replaced it with its own edits,
+        which this worker's item hashes and labels know nothing about.
+        """
+        if not self._mmapped:
+            return
+
+        if self.index_type == 'ivf':
+            # Serialising mapped inverted lists only records the file they live in,
+            # so copy the lists into memory and swap them in
+            ivf = faiss.extract_index_ivf(self.index)
+            invlists = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+            for list_no in range(ivf.nlist):
+                invlists.add_entries(list_no, ivf.invlists.list_size(list_no),
+                                     ivf.invlists.get_ids(list_no), ivf.invlists.get_codes(list_no))
+            ivf.replace_invlists(invlists, True)
+            invlists.this.disown()
+        else:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            set_search_params(self.index, ivf_nprobe=self.ivf_nprobe, hnsw_ef_search=self.hnsw_ef_search)
+        self._mmapped = False
+
+    def _remove_ids(self, item_ids: List[int]):
+        """Remove vectors by id; HNSW graphs cannot delete, so their vectors are tombstoned"""
+        if self.index_type != 'hnsw':
+            self.index.remove_ids(np.asarray(item_ids, dtype='int64'))
+            return
+
+        for item_id in item_ids:
+            label = self._labels.pop(item_id, None)
+            if label is not None:
+                self._stale_labels.add(label)
+
+    def _compact(self):
+        """Rebuild the HNSW graph without its tombstones once they take up too much of it.
+
+        Quantized HNSW rebuilds from decoded vectors, so each rebuild adds a
+        little quantization error until the next full build from the database.
+        """
+        if not self._stale_labels or self.index is None:
+            return
+        if (len(self._stale_labels) <= HNSW_MAX_TOMBSTONE_FRACTION * self.index.ntotal
+                and self._next_generation <= MAX_LABEL_GENERATION):
+            return
+
+        labels = faiss.vector_to_array(self.index.id_map)
+        keep = np.array([label not in self._stale_labels for label in labels.tolist()], dtype=bool)
+        if not keep.any():
+            self.index = None
+            self._reset_labels([])
+            return
+
+        embeddings = self.index.index.reconstruct_n(0, self.index.ntotal)[keep]
+        item_ids = labels[keep] & LABEL_ID_MASK
+        index = self._create_index(embeddings)
+        index.add_with_ids(embeddings, item_ids)
+        self.index = index
+        self._set_trained(len(embeddings))
+        self._reset_labels(item_ids.tolist())
+
+    def _new_label(self, item_id: int) -> int:
+        if self.index_type != 'hnsw':
+            return item_id
+        # The plain id is free unless a vector of this item, live or tombstoned, still carries it
+        label = item_id
+        if item_id in self._labels or item_id in self._stale_labels:
+            label = (self._next_generation << LABEL_ID_BITS) | item_id
+            self._next_generation += 1
+        self._labels[item_id] = label
+        return label
+
+    def upsert(self, item_id: int, embedding: np.ndarray, item_hash: str):
+        """Insert or replace the vector for a single knowledge base item"""
+        vector = np.ascontiguousarray(embedding, dtype='float32').reshape(1, -1)
+
+        with self._lock:
+            if self.index is not None:
+                self._ensure_writable()
+                if item_id in self.item_hashes:
+                    self._remove_ids([item_id])
+            if self.index is None:
+                self.index = self._create_index(vector)
+                self._set_trained(1)
+                self._reset_labels([])
+
+            label = self._new_label(item_id)
+            self.index.add_with_ids(vector, np.asarray([label], dtype='int64'))
+            self.item_hashes[item_id] = item_hash
+            if self.index_type == 'hnsw':
+                self._compact()
+
+    def remove(self, item_id: int) -> bool:
+        """Drop a knowledge base item from the index"""
+        with self._lock:
+            if self.index is None or item_id not in self.item_hashes:
+                return False
+
+            self._ensure_writable()
+            self._remove_ids([item_id])
+            del self.item_hashes[item_id]
+            if self.index_type == 'hnsw':
+                self._compact()
+            return True
+
+    def save(self):
+        """Write the snapshot atomically so concurrent workers never read a partial file"""
+        with self._lock:
+            if self.index is None:
+                return
+
+            os.makedirs(self.index_dir, exist_ok=True)
+
+            tmp_index_path = f"{self.index_path}.tmp{os.getpid()}"
+            faiss.write_index(self.index, tmp_index_path)
+            os.replace(tmp_index_path, self.index_path)
+
+            meta = {
+                'version': SNAPSHOT_VERSION,
+                'model_name': self.model_name,
+                'index_type': self.index_type,
+                'quantization': self.trained_quantization,
+                'trained_size': self.trained_size,
+                'ivf_nlist': faiss.extract_index_ivf(self.index).nlist if self.index_type == 'ivf' else 0,
+                'content_hash': self.content_hash,
+                'dimension': self.index.d,
+                'size': self.index.ntotal,
+            }
+            tmp_meta_path = f"{self.meta_path}.tmp{os.getpid()}"
+            with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_meta_path, self.meta_path)
+
+    def set_categories(self, categories: Dict[int, str]):
+        """Replace the category of every item, as {item id: category}"""
+        members: Dict[str, Set[int]] = {}
+        for item_id, category in categories.items():
+            members.setdefault(category, set()).add(item_id)
+        with self._lock:
+            self.category_members = members
+
+    def set_category(self, item_id: int, category: Optional[str]):
+        """Move one item into a category, or out of all of them with None"""
+        with self._lock:
+            for category_name in list(self.category_members):
+                members = self.category_members[category_name]
+                members.discard(item_id)
+                if not members:
+                    del self.category_members[category_name]
+            if category:
+                self.category_members.setdefault(category, set()).add(item_id)
+
+    def category_ids(self, category: str) -> Set[int]:
+        """Ids of the items in a category"""
+        return self.category_members.get(category, set())
+
+    def search(self, query_embedding: np.ndarray, top_k: int,
+               allowed_ids: Optional[Iterable[int]] = None) -> List[int]:
+        """Return the knowledge base ids closest to the query embedding, optionally only among allowed_ids"""
+        query = np.ascontiguousarray(query_embedding, dtype='float32').reshape(1, -1)
+
+        with self._lock:
+            if self.size == 0:
+                return []
+            if allowed_ids is None and not self._stale_labels:
+                _, I = self.index.search(query, min(top_k, self.size))
+                return [int(item_id) for item_id in I[0] if item_id != -1]
+
+            if allowed_ids is None:
+                # Skip tombstoned HNSW vectors
+                stale = faiss.IDSelectorBatch(np.fromiter(self._stale_labels, dtype='int64',
+                                                          count=len(self._stale_labels)))
+                selector = faiss.IDSelectorNot(stale)
+                allowed = None
+            else:
+                allowed = set(allowed_ids)
+                labels = [self._labels[item_id] for item_id in allowed if item_id in self._labels] \
+                    if self.index_type == 'hnsw' else [item_id for item_id in allowed if item_id in self.item_hashes]
+                if not labels:
+                    return []
+                selector = faiss.IDSelectorBatch(np.asarray(labels, dtype='int64'))
+            params = selector_search_params(
+                self.index, selector, ivf_nprobe=self.ivf_nprobe, hnsw_ef_search=self.hnsw_ef_search
+            )
+            try:
+                _, I = self.index.search(query, min(top_k, self.size), params=params)
+                return [int(label) & LABEL_ID_MASK for label in I[0] if label != -1]
+            except RuntimeError:
+                # Some index types (e.g. flat PQ) cannot filter during the search
+                if allowed is not None:
+                    return self._search_labels(query, labels, top_k)
+                _, I = self.index.search(query, min((top_k + len(self._stale_labels)) * FILTER_OVERFETCH,
+                                                    self.index.ntotal))
+                return [int(label) & LABEL_ID_MASK for label in I[0]
+                        if label != -1 and int(label) not in self._stale_labels][:top_k]
+
+    def _search_labels(self, query: np.ndarray, labels: List[int], top_k: int) -> List[int]:
+        """Exact search among the given labels only, by decoding their vectors.
+
+        Costs one pass over the selected vectors, never more than the flat
+        scan it replaces, and finds them however small a share of the index
+        they are.
+        """
+        keys = np.asarray(labels, dtype='int64')
+        vectors = self.index.reconstruct_batch(keys)
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        nearest = np.argsort(distances)[:top_k]
+        return [int(keys[i]) & LABEL_ID_MASK for i in nearest]